@@ -1,8 +1,20 @@
 import os
+import re
+import bz2
+import gzip
 import stat
 import json
+import socket
+import struct
 import copy
+import time
+import shutil
+import operator
+import atexit
 import logging
+import weakref
+import threading
+import datetime
 import collections
 import logging.handlers
 
@@ -15,6 +27,32 @@ except BaseException:
 
     str_types = (str,)
 
+try:
+    from Queue import Queue, Full
+except BaseException:
+    from queue import Queue, Full
+
+try:
+    import lzma
+except BaseException:
+    lzma = None
+
+try:
+    import fcntl
+except BaseException:
+    fcntl = None
+
+try:
+    import multiprocessing
+    from multiprocessing import shared_memory
+except BaseException:
+    shared_memory = None
+
+try:
+    import contextvars
+except BaseException:
+    contextvars = None
+
 
 class Logger(logging.getLoggerClass()):
     """
@@ -43,6 +81,20 @@ class Logger(logging.getLoggerClass()):
     LOGFORMAT = "%(asctime)s.%(msecs)03d %(process)s:%(thread)u %(levelname)-8s %(module)15.15s %(lineno)-4s: %(message)s"
     """Default log format for all handlers. This can change in :py:meth:`init`"""
 
+    QUEUESIZE = 10000
+    """Default maximum number of records waiting to be written in queue mode"""
+
+    STATS = True
+    """Collect per-handler statistics, see :py:meth:`stats`"""
+
+    STATSINTERVAL = 15
+    """Seconds between writes of the ``statsFile`` given to :py:meth:`init`"""
+
+    _queue = None
+    _listener = None
+    _atexit = False
+    _statsStop = None
+
     @classmethod
     def _chkdir(cls):
         """
@@ -64,17 +116,41 @@ class Logger(logging.getLoggerClass()):
             {
                 'filename': Filename (under LOGDIR)
                 'level': Logging level for this file
-                'format': [ 'json' | 'console' | 'default' ] # TODO: CSV
+                'format': [ 'json' | 'console' | 'default' | 'binary' ] # TODO: CSV
                 'backupCount': Number of files to keep
                 'maxBytes': Maximum file size
+                'fields': Record attributes to include (json only)
+                'static': Dict of constant fields, ie: hostname (json only)
+                'timestamp': [ 'epoch' | 'iso' ] (json only)
+                'bufferSize': Number of records written together (default 1)
+                'flushInterval': Max milliseconds a buffered record waits
+                'flushLevel': Records at or above this level flush immediately
+                'fsync': False, True (every flush) or min seconds between fsyncs
+                'rotation': [ 'cascade' | 'sequence' | 'timestamp' ]
+                'maxTotalBytes': Maximum total size of the backups
+                'compress': [ 'gzip' | 'bz2' | 'lzma' ], needs 'sequence' or 'timestamp'
+                'multiprocess': Several processes write this file
+                'index': Keep a time/offset index in <filename>.idx
+                'indexRecords': Max records per index entry
+                'indexBytes': Max bytes per index entry
+                'rateLimit': RateLimitFilter arguments, ie: {'rate': 10, 'burst': 100}
+                'dedup': Collapse repeated records, True or DedupFilter arguments
             }
 
         If format is set to "console", then ColorFormatter options are also
         supported.
         """
+        handler = cls._fileHandler(specs)
+        if handler is not None:
+            cls._addHandler(handler)
+            cls.updateLevel()
 
-        root = logging.getLogger()
-
+    @classmethod
+    def _fileHandler(cls, specs):
+        """
+        Build the handler of :py:meth:`addFileLogger` without attaching it.
+        Returns None if the file is not writable
+        """
         if "filename" not in specs:
             raise RuntimeError('"filename" missing from file specs... skipping!')
 
@@ -94,7 +170,7 @@ class Logger(logging.getLoggerClass()):
                 % filePath
             )
             # No point doing anything else! BUT do not raise exception
-            return
+            return None
 
         # If we just created it, set correct permissions so that is group accessible
         # This often crashes apps in multiuser environmnets
@@ -114,10 +190,24 @@ class Logger(logging.getLoggerClass()):
             pass
 
         # Register the rotating file handler
-        rotFileH = logging.handlers.RotatingFileHandler(
+        handlerClass = RotatingFileHandler
+        if specs.get("format") == "binary":
+            handlerClass = BinaryFileHandler
+        rotFileH = handlerClass(
             filePath,
             backupCount=specs.get("backupCount", cls.BACKUPCOUNT),
             maxBytes=specs.get("maxBytes", cls.MAXBYTES),
+            bufferSize=specs.get("bufferSize", 1),
+            flushInterval=specs.get("flushInterval", RotatingFileHandler.FLUSHINTERVAL),
+            flushLevel=specs.get("flushLevel", logging.ERROR),
+            fsync=specs.get("fsync", False),
+            rotation=specs.get("rotation", "cascade"),
+            maxTotalBytes=specs.get("maxTotalBytes", 0),
+            compress=specs.get("compress"),
+            multiprocess=specs.get("multiprocess", False),
+            index=specs.get("index", False),
+            indexRecords=specs.get("indexRecords", RotatingFileHandler.INDEXRECORDS),
+            indexBytes=specs.get("indexBytes", RotatingFileHandler.INDEXBYTES),
         )
 
         fmt = specs.get("fmt", cls.USER_LOGFORMAT)
@@ -132,17 +222,67 @@ class Logger(logging.getLoggerClass()):
                 color=False,
                 pretty=specs["pretty"],
                 splitLines=specs["splitLines"],
+                maxDepth=specs["maxDepth"],
+                maxItems=specs["maxItems"],
+                maxChars=specs["maxChars"],
             )
 
-        elif specs["format"] == "default":
+        elif specs["format"] in ("default", "binary"):
             pass
         elif specs["format"] == "json":
-            formatter = JSONFormatter(specs.get("fields", JSONFormatter.FIELDS))
+            formatter = JSONFormatter(
+                specs.get("fields", JSONFormatter.FIELDS),
+                static=specs.get("static"),
+                timestamp=specs.get("timestamp", "epoch"),
+            )
 
         rotFileH.setFormatter(formatter)
         rotFileH.setLevel(specs["level"])
         rotFileH.propagate = False
-        root.addHandler(rotFileH)
+        cls._addFilters(rotFileH, specs)
+        if cls.STATS:
+            HandlerStats.install(rotFileH, specs["filename"])
+        return rotFileH
+
+    @staticmethod
+    def _addFilters(handler, specs):
+        """
+        Install the :py:class:`DedupFilter` of ``specs["dedup"]`` and the
+        :py:class:`RateLimitFilter` of ``specs["rateLimit"]``, in this order
+        so that repeats do not use up the rate
+        """
+        filters = []
+        dedup = specs.get("dedup")
+        if dedup:
+            kwargs = dedup if isinstance(dedup, dict) else {}
+            filters.append(DedupFilter(handler=handler, **kwargs))
+
+        limits = specs.get("rateLimit")
+        if limits:
+            filters.append(RateLimitFilter(handler=handler, **limits))
+
+        if not filters:
+            return
+        for f in filters:
+            handler.addFilter(f)
+
+        # Their summaries are written before the handler flushes or closes
+        # (ie: at exit), rather than lost with their timers
+        flush = handler.flush
+        close = handler.close
+
+        def filtersFlush():
+            for f in filters:
+                f.flush()
+            flush()
+
+        def filtersClose():
+            for f in filters:
+                f.flush()
+            close()
+
+        handler.flush = filtersFlush
+        handler.close = filtersClose
 
     @classmethod
     def init(
@@ -152,6 +292,11 @@ class Logger(logging.getLoggerClass()):
         fileSpecs=None,
         fmt=None,
         datefmt=None,
+        queue=False,
+        queueSize=None,
+        statsFile=None,
+        collector=None,
+        ringSize=None,
     ):
         """
         Initialize logging based on the requested fileName. This
@@ -160,7 +305,25 @@ class Logger(logging.getLoggerClass()):
 
         :param str fileSpecs: A dict with 'filename', 'level', etc. See addFileLogger
                               for details
-        :param int termSpecs: A dict with boolean values for 'color' and 'splitLines'
+        :param int termSpecs: A dict with boolean values for 'color' and 'splitLines',
+                              'rateLimit' and 'dedup' as in the file specs
+        :param bool queue: If set, records are passed through a bounded queue to
+                           a background thread that does all the formatting and
+                           writing. Records are dropped if the queue is full
+        :param int queueSize: Maximum number of queued records (default
+                              :py:attr:`QUEUESIZE`)
+        :param str statsFile: If set, :py:meth:`stats` are written there in
+                              Prometheus text format every
+                              :py:attr:`STATSINTERVAL` seconds
+        :param str collector: Unix socket of a ``python -m lazylog.collector``.
+                              Records for the files are sent there instead
+                              (one :py:class:`CollectorHandler` replaces the
+                              file handlers) and ``fileSpecs`` are only used
+                              when the collector is not reachable
+        :param int ringSize: If set, like ``queue`` but through a
+                             :py:class:`SharedRing` of this many bytes, so
+                             processes forked later (ie: worker pools) log
+                             through it too and the parent writes for all
         """
 
         logging.setLoggerClass(cls)
@@ -184,11 +347,21 @@ class Logger(logging.getLoggerClass()):
         # Merge with defaults...
         termSpecs = ColorFormatter.parseSpecs(termSpecs, ColorFormatter.TERMDEFAULTS)
 
-        # Disable default logger
+        # Drain any previous queue before dropping its handlers
+        cls.stopQueue()
+
+        # Disable default logger, writing out anything buffered first
         root = logging.getLogger()
         root.setLevel(logging.DEBUG)
+        for h in root.handlers:
+            h.flush()
         root.handlers = []
 
+        if ringSize:
+            cls._startRing(ringSize)
+        elif queue:
+            cls._startQueue(queueSize if queueSize is not None else cls.QUEUESIZE)
+
         # Console logger
         console = logging.StreamHandler()
         console.setLevel(termSpecs["level"])
@@ -199,18 +372,67 @@ class Logger(logging.getLoggerClass()):
                 color=termSpecs["color"],
                 splitLines=termSpecs["splitLines"],
                 pretty=termSpecs["pretty"],
+                maxDepth=termSpecs["maxDepth"],
+                maxItems=termSpecs["maxItems"],
+                maxChars=termSpecs["maxChars"],
             )
         elif termSpecs["format"] == "json":
-            formatter = JSONFormatter(termSpecs.get("fields", JSONFormatter.FIELDS))
+            formatter = JSONFormatter(
+                termSpecs.get("fields", JSONFormatter.FIELDS),
+                static=termSpecs.get("static"),
+                timestamp=termSpecs.get("timestamp", "epoch"),
+            )
         console.setFormatter(formatter)
         console.propagate = False
-        root.addHandler(console)
+        cls._addFilters(console, termSpecs)
+        if cls.STATS:
+            HandlerStats.install(console, "console")
+        cls._addHandler(console)
 
         # File logger
-        if fileSpecs is not None:
+        if fileSpecs and collector is not None:
+            cls._addCollector(collector, fileSpecs)
+        elif fileSpecs is not None:
             for specs in fileSpecs:
                 cls.addFileLogger(specs)
 
+        cls.updateLevel()
+
+        if cls._statsStop is not None:
+            cls._statsStop.set()
+            cls._statsStop = None
+        if statsFile is not None:
+            cls._startStatsFile(statsFile)
+
+    @classmethod
+    def _addCollector(cls, path, fileSpecs):
+        """
+        Send the records of ``fileSpecs`` to the collector at ``path``, with
+        those files as the local fallback
+        """
+
+        def fallback():
+            handlers = []
+            for specs in fileSpecs:
+                specs = dict(specs)
+                if (
+                    fcntl is not None
+                    and specs.get("format") != "binary"
+                    and not specs.get("index")
+                ):
+                    # Every worker falls back to the same files
+                    specs.setdefault("multiprocess", True)
+                handler = cls._fileHandler(specs)
+                if handler is not None:
+                    handlers.append(handler)
+            return handlers
+
+        handler = CollectorHandler(path, fallback=fallback)
+        handler.setLevel(min(specs.get("level", logging.INFO) for specs in fileSpecs))
+        if cls.STATS:
+            HandlerStats.install(handler, "collector")
+        cls._addHandler(handler)
+
     @staticmethod
     def logFun():
         """Print one message in each level to demo the colours"""
@@ -220,205 +442,2778 @@ class Logger(logging.getLoggerClass()):
         logging.critical("Critical stuff appear like this")
         logging.error("Look out for ERRORs")
 
-    @staticmethod
-    def setConsoleLevel(level):
+    @classmethod
+    def _startQueue(cls, size, handlers=()):
+        """
+        Install a :py:class:`QueueHandler` on the root logger and start the
+        background thread that feeds the real handlers
+        """
+        cls._queue = Queue(size)
+        cls._listener = QueueListener(cls._queue, *handlers, respect_handler_level=True)
+        cls._listener.start()
+
+        # Swapped in one go, no record is lost or written twice meanwhile
+        logging.getLogger().handlers = [QueueHandler(cls._queue)]
+
+        if not cls._atexit:
+            atexit.register(cls.stopQueue)
+            cls._atexit = True
+
+    @classmethod
+    def _startRing(cls, size):
+        """
+        Install a :py:class:`RingHandler` on the root logger and start the
+        thread that drains the ring into the real handlers
+        """
+        ring = SharedRing(size)
+        cls._listener = RingListener(ring)
+        cls._listener.start()
+        logging.getLogger().addHandler(RingHandler(ring))
+
+        if not cls._atexit:
+            atexit.register(cls.stopQueue)
+            cls._atexit = True
+
+    @classmethod
+    def startQueue(cls, queueSize=None):
+        """
+        Switch to queue mode (see ``queue`` in :py:meth:`init`) after init,
+        the current handlers move to the background thread. Does nothing if
+        already in queue or ring mode
+        """
+        if cls._listener is not None:
+            return
+
+        cls._startQueue(
+            queueSize if queueSize is not None else cls.QUEUESIZE,
+            tuple(logging.getLogger().handlers),
+        )
+
+    @classmethod
+    def stopQueue(cls):
+        """
+        Write everything still queued, stop the background thread and move
+        its handlers back to the root logger (synchronous mode). Safe to call
+        in non-queue mode. Same for the ring mode
+        """
+        if cls._listener is None:
+            return
+
+        listener = cls._listener
+        cls._listener = None
+        cls._queue = None
+
+        root = logging.getLogger()
+        for h in list(root.handlers):
+            if isinstance(h, (QueueHandler, RingHandler)):
+                root.removeHandler(h)
+
+        listener.stop()
+        for h in listener.handlers:
+            h.flush()
+            root.addHandler(h)
+
+    @classmethod
+    def flush(cls):
+        """
+        Block until all queued records have been handled. Does nothing in
+        non-queue mode as records are written synchronously
+        """
+        if cls._queue is not None:
+            cls._queue.join()
+        elif cls._listener is not None:
+            cls._listener.flush()
+
+    @classmethod
+    def dropped(cls):
+        """
+        Number of records dropped because the queue (or ring) was full
+        """
+        for h in logging.getLogger().handlers:
+            if isinstance(h, (QueueHandler, RingHandler)):
+                return h.dropped
+        return 0
+
+    @classmethod
+    def _addHandler(cls, handler):
+        """
+        Attach a handler either to the root logger or, in queue mode, to the
+        background listener
+        """
+        if cls._listener is not None:
+            # Replace rather than mutate, the listener iterates over it
+            cls._listener.handlers = cls._listener.handlers + (handler,)
+        else:
+            logging.getLogger().addHandler(handler)
+
+    @classmethod
+    def getHandlers(cls):
+        """
+        Return the handlers doing the actual output. In queue mode these are
+        attached to the background listener instead of the root logger
+        """
+        if cls._listener is not None:
+            return cls._listener.handlers
+
+        return logging.getLogger().handlers
+
+    @classmethod
+    def stats(cls):
+        """
+        Return a list with the counters of each handler (in handler order)::
+
+            {
+                'handler': Handler index (0 is the console)
+                'name': 'console' or the filename
+                'emitted': Records written
+                'filtered': Records not written because of the handler's
+                            level or filters
+                'bytes': Bytes written (encoded)
+                'rotations': Number of rollovers (file handlers)
+                'errors': Errors while writing
+                'formatTime', 'formatMax': Total and max seconds formatting
+                'emitTime', 'emitMax': Total and max seconds writing,
+                                       including formatting
+            }
+
+        Records below every handler's level never reach the handlers, so
+        ``filtered`` counts the records the busiest handler saw but this one
+        did not write
+        """
+        handlers = cls.getHandlers()
+        collected = [
+            (i, h.stats)
+            for i, h in enumerate(handlers)
+            if isinstance(getattr(h, "stats", None), HandlerStats)
+        ]
+        seen = max([st.calls for _, st in collected] or [0])
+
+        result = []
+        for i, st in collected:
+            result.append(
+                {
+                    "handler": i,
+                    "name": st.name,
+                    "emitted": st.emitted,
+                    "filtered": seen - st.calls + st.rejected,
+                    "bytes": st.bytes,
+                    "rotations": getattr(handlers[i], "rotations", 0),
+                    "errors": st.errors,
+                    "formatTime": st.formatTime,
+                    "formatMax": st.formatMax,
+                    "emitTime": st.emitTime,
+                    "emitMax": st.emitMax,
+                }
+            )
+
+        return result
+
+    @classmethod
+    def dumpStats(cls, path):
+        """
+        Write :py:meth:`stats` to ``path`` in Prometheus text format, ie: for
+        node_exporter's textfile collector. The file is replaced atomically
+        """
+        lines = []
+        stats = cls.stats()
+        for key, metric, kind, doc in HandlerStats.METRICS:
+            lines.append("# HELP lazylog_%s %s" % (metric, doc))
+            lines.append("# TYPE lazylog_%s %s" % (metric, kind))
+            for st in stats:
+                lines.append(
+                    'lazylog_%s{handler="%d",name="%s"} %s'
+                    % (
+                        metric,
+                        st["handler"],
+                        HandlerStats.escape(st["name"]),
+                        repr(st[key]),
+                    )
+                )
+
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp, path)
+
+    @classmethod
+    def _startStatsFile(cls, path):
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(cls.STATSINTERVAL):
+                try:
+                    cls.dumpStats(path)
+                except Exception:
+                    pass
+
+        t = threading.Thread(target=loop, name="lazylog-stats")
+        t.daemon = True
+        t.start()
+        cls._statsStop = stop
+
+    @classmethod
+    def updateLevel(cls):
+        """
+        Set the root logger level to the lowest handler level. Records that no
+        handler would write are then dropped by ``logging.debug()`` & co before
+        a LogRecord is even created. Called whenever lazylog changes handlers
+        or levels; call it if you change a handler's level directly
+        """
+        levels = [h.level for h in cls.getHandlers()]
+        logging.getLogger().setLevel(min(levels) if levels else logging.DEBUG)
+
+    @classmethod
+    def setConsoleLevel(cls, level):
         """
         In this logger, by convention, handler 0 is always the console halder.
         """
-        logging.getLogger().handlers[0].setLevel(level)
+        cls.getHandlers()[0].setLevel(level)
+        cls.updateLevel()
 
-    @staticmethod
-    def setFileLevel(filenum, level):
+    @classmethod
+    def setFileLevel(cls, filenum, level):
         """
         Set a file logger log level. Filenum is 1,2,3,.. in the order the
         files have been added.
         """
-        if len(logging.getLogger().handlers) < filenum + 1:
+        if len(cls.getHandlers()) < filenum + 1:
             return
 
-        logging.getLogger().handlers[filenum].setLevel(level)
+        cls.getHandlers()[filenum].setLevel(level)
+        cls.updateLevel()
 
-    @staticmethod
-    def mockHandler(index):
-        if len(logging.getLogger().handlers) < index + 1:
+    @classmethod
+    def mockHandler(cls, index):
+        if len(cls.getHandlers()) < index + 1:
             return
 
-        h = logging.getLogger().handlers[index]
+        # Anything logged so far belongs to the real stream
+        cls.flush()
 
-        h.old_stream = h.stream
-        h.stream = StringIO()
+        h = cls.getHandlers()[index]
+
+        h.acquire()
+        try:
+            h.flush()
+            h.old_stream = h.stream
+            h.stream = StringIO()
+        finally:
+            h.release()
         return h.stream
 
-    @staticmethod
-    def restoreHandler(index):
-        if len(logging.getLogger().handlers) < index + 1:
+    @classmethod
+    def restoreHandler(cls, index):
+        if len(cls.getHandlers()) < index + 1:
             return
 
-        h = logging.getLogger().handlers[index]
+        # ... and anything logged while mocked belongs to the mock
+        cls.flush()
+
+        h = cls.getHandlers()[index]
 
         if not hasattr(h, "old_stream"):
             return
 
-        h.stream = h.old_stream
-        del h.old_stream
+        h.acquire()
+        try:
+            h.flush()
+            h.stream = h.old_stream
+            del h.old_stream
+        finally:
+            h.release()
 
 
-class ColorFormatter(logging.Formatter):
+class HandlerStats(object):
     """
-    Color formatter. This class is working as expected atm but it can
-    be tidied up to support blinking text and other useless features :)
+    Counters of a single handler, see :py:meth:`Logger.stats`. They are
+    collected by wrapping the handler's methods on the instance, so the
+    handler itself (level, stream, mocking) is not affected
     """
 
-    BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
-    """ Bash Colors """
+    METRICS = (
+        ("emitted", "records_emitted_total", "counter", "Records written"),
+        (
+            "filtered",
+            "records_filtered_total",
+            "counter",
+            "Records not written (level/filters)",
+        ),
+        ("bytes", "bytes_written_total", "counter", "Bytes written"),
+        ("rotations", "rotations_total", "counter", "File rollovers"),
+        ("errors", "write_errors_total", "counter", "Errors while writing"),
+        ("formatTime", "format_seconds_total", "counter", "Time spent formatting"),
+        ("formatMax", "format_seconds_max", "gauge", "Slowest format"),
+        ("emitTime", "emit_seconds_total", "counter", "Time spent writing"),
+        ("emitMax", "emit_seconds_max", "gauge", "Slowest write"),
+    )
+    """Prometheus metrics as (stats key, name, type, help)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.rejected = 0
+        self.emitted = 0
+        self.bytes = 0
+        self.errors = 0
+        self.formatTime = 0.0
+        self.formatMax = 0.0
+        self.emitTime = 0.0
+        self.emitMax = 0.0
 
-    NORM, BOLD, UNK, ITAL, UNDER, BLINK, UNK2, INV, CON = range(9)
-    """ Bash Styles """
+    @classmethod
+    def install(cls, handler, name):
+        """
+        Start collecting stats for ``handler``, available as ``handler.stats``
+        """
+        if isinstance(getattr(handler, "stats", None), HandlerStats):
+            return handler.stats
+
+        stats = cls(name)
+        clock = time.perf_counter
+        terminator = len(getattr(handler, "terminator", ""))
+
+        # File handlers count the bytes of what they buffer, the text of
+        # others (ie: the console) is encoded here
+        sized = hasattr(handler, "bytesWritten")
+        stream = getattr(handler, "stream", None)
+        encoding = getattr(stream, "encoding", None) or "utf-8"
+        handle = handler.handle
+        format = handler.format
+        emit = handler.emit
+        handleError = handler.handleError
+
+        def statsHandle(record):
+            stats.calls += 1
+            rv = handle(record)
+            if not rv:
+                stats.rejected += 1
+            return rv
+
+        def statsFormat(record):
+            start = clock()
+            msg = format(record)
+            took = clock() - start
+            stats.formatTime += took
+            if took > stats.formatMax:
+                stats.formatMax = took
+            if not sized:
+                stats.bytes += len(msg.encode(encoding, "replace")) + terminator
+            return msg
 
-    ESC = "\033["
-    """Escape sequence for color"""
-    COLOR_SEQ = "\033[1;%dm"
-    """Escape seq. + color integer placeholder"""
-    RESET_SEQ = "\033[0m"
-    """Reset color sequence"""
+        def statsEmit(record):
+            start = clock()
+            if sized:
+                written = handler.bytesWritten
+                emit(record)
+                stats.bytes += handler.bytesWritten - written
+            else:
+                emit(record)
+            took = clock() - start
+            stats.emitted += 1
+            stats.emitTime += took
+            if took > stats.emitMax:
+                stats.emitMax = took
+
+        def statsHandleError(record):
+            stats.errors += 1
+            handleError(record)
+
+        handler.handle = statsHandle
+        handler.format = statsFormat
+        handler.emit = statsEmit
+        handler.handleError = statsHandleError
+        handler.stats = stats
+        return stats
 
-    TERMDEFAULTS = {
-        "color": True,
-        "splitLines": True,
-        "level": logging.DEBUG,
-        "pretty": True,
-    }
-    """Terminal default settings"""
+    @staticmethod
+    def escape(value):
+        """
+        Escape a Prometheus label value
+        """
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-    FILEDEFAULTS = {
-        "color": False,
-        "splitLines": True,
-        "level": logging.INFO,
-        "pretty": False,
-    }
-    """File default settings"""
 
-    STYLES = {
-        "DEBUG": NORM,
-        "INFO": NORM,
-        "WARNING": NORM,
-        "CRITICAL": BOLD,
-        "ERROR": BOLD,
-    }
-    """Each log-level's default character style"""
+class RateLimitFilter(logging.Filter):
+    """
+    Limits the records of each call site (``pathname`` or ``module`` with
+    ``lineno``) before anything is formatted. Per level, either a token
+    bucket of ``rate`` records per second with bursts up to ``burst``, or
+    ``sample``: keep 1 in N. Both take a number (every level) or a dict
+    ``{level: value}`` (only those levels).
+
+    ``interval`` seconds after the last summary (or on :py:meth:`flush`), a
+    WARNING summarizes what was suppressed (busiest sites first) and goes to
+    ``handler``, or to the ``lazylog.ratelimit`` logger if there is none
+    """
 
-    COLORS = {
-        "DEBUG": WHITE,
-        "INFO": CYAN,
-        "WARNING": YELLOW,
-        "CRITICAL": YELLOW,
-        "ERROR": RED,
-    }
-    """Default color values for each log-level"""
+    INTERVAL = 60
+    """Default seconds between summaries of the suppressed records"""
+
+    NAME = "lazylog.ratelimit"
+    """Logger name of the summary records, never limited"""
+
+    TOP = 5
+    """Call sites listed in a summary"""
 
     def __init__(
         self,
-        fmt,
-        datefmt=None,
-        color=True,
-        splitLines=True,
-        pretty=False,
-        colors=None,
-        styles=None,
+        rate=None,
+        burst=None,
+        sample=None,
+        interval=INTERVAL,
+        key="pathname",
+        handler=None,
     ):
+        logging.Filter.__init__(self)
+        if key not in ("pathname", "module"):
+            raise RuntimeError('Unknown rate limit key "%s"' % key)
+
+        self.rate = self._perLevel(rate)
+        self.burst = self._perLevel(burst)
+        self.sample = self._perLevel(sample)
+        for value in self.rate.values():
+            if value is not None and value < 0:
+                raise RuntimeError('Invalid rate limit rate "%s"' % value)
+        for value in self.sample.values():
+            if value is not None and value < 1:
+                raise RuntimeError('Invalid rate limit sample "%s"' % value)
+        self.interval = interval
+        self.key = key
+        self.handler = handler
+
+        # (site, lineno) -> [tokens, last refill, records seen]
+        self._sites = {}
+        self._suppressed = collections.Counter()
+        self._lock = threading.Lock()
+        self._since = time.time()
+        self._timer = None
+
+    @staticmethod
+    def _perLevel(value):
         """
-        Init given the log line format, color and date format
+        ``{levelno: value}`` with None for all levels (JSON config may give
+        level names or numbers as strings)
         """
-        logging.Formatter.__init__(self, fmt, datefmt)
-        self.color = color
-        self.splitLines = splitLines
-        self.pretty = pretty
-
-        self.colors = colors if colors is not None else ColorFormatter.COLORS
-        self.styles = styles if styles is not None else ColorFormatter.STYLES
+        if not isinstance(value, dict):
+            return {None: value}
+        out = {None: None}
+        for level, v in value.items():
+            if isinstance(level, str):
+                level = (
+                    int(level)
+                    if level.isdigit()
+                    else logging.getLevelName(level.upper())
+                )
+            out[level] = v
+        return out
+
+    def filter(self, record):
+        if record.name in (self.NAME, DedupFilter.NAME):
+            return True
+
+        if self._suppressed and record.created - self._since >= self.interval:
+            self._report(record.created)
+
+        levelno = record.levelno
+        rate = self.rate.get(levelno, self.rate[None])
+        sample = self.sample.get(levelno, self.sample[None])
+        if rate is None and sample is None:
+            return True
+
+        key = (getattr(record, self.key), record.lineno)
+        now = record.created
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [None, now, 0]
+            site[2] += 1
+
+            keep = True
+            if sample is not None and (site[2] - 1) % sample:
+                keep = False
+            elif rate is not None:
+                # Buckets start full
+                burst = self.burst.get(levelno, self.burst[None]) or max(rate, 1)
+                tokens = (
+                    burst
+                    if site[0] is None
+                    else min(burst, site[0] + (now - site[1]) * rate)
+                )
+                site[1] = now
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    keep = False
+                site[0] = tokens
+
+            if not keep:
+                self._suppressed[key] += 1
+                if self._timer is None:
+                    # Summarized even if nothing else is logged
+                    self._timer = threading.Timer(
+                        max(self._since + self.interval - time.time(), 0), self.flush
+                    )
+                    self._timer.daemon = True
+                    self._timer.start()
+        return keep
+
+    def flush(self):
+        """
+        Write the summary of the suppressed records, if any
+        """
+        self._report(time.time())
 
-    def format(self, record):
+    def _report(self, now):
         """
-        Override format function
+        Emit the summary of what was suppressed and start counting again
         """
-        levelname = record.levelname
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            counts = self._suppressed
+            if not counts:
+                # Another thread was first
+                return
+            self._suppressed = collections.Counter()
+            since, self._since = self._since, now
+
+        sites = ", ".join(
+            "%s:%d (%d)" % (site, lineno, n)
+            for (site, lineno), n in counts.most_common(self.TOP)
+        )
+        if len(counts) > self.TOP:
+            sites += ", ..."
+        record = logging.LogRecord(
+            self.NAME,
+            logging.WARNING,
+            __file__,
+            0,
+            "Suppressed %d records from %d call sites in the last %ds: %s",
+            (sum(counts.values()), len(counts), now - since, sites),
+            None,
+            "filter",
+        )
+        record.suppressed = dict(("%s:%d" % key, n) for key, n in counts.items())
 
-        # Keep reference and copy only if required
-        tmp_record = record
+        if self.handler is None:
+            logging.getLogger(self.NAME).handle(record)
+        elif record.levelno >= self.handler.level:
+            self.handler.handle(record)
 
-        # NOTE: `message` is formatted, `msg` is raw
-        if self.pretty and (
-            isinstance(record.msg, dict)
-            or isinstance(record.msg, tuple)
-            or isinstance(record.msg, list)
-        ):
 
-            # Copy so we do not modify the original message
-            tmp_record = copy.copy(record)
-            tmp_record.msg = pretty(tmp_record.msg)
+class DedupFilter(logging.Filter):
+    """
+    Collapses identical consecutive records (same level, call site and
+    message) into the first one plus a "Last message repeated N times" record,
+    written when a different record comes, ``timeout`` seconds after the
+    first repeat or on :py:meth:`flush` (called when the handler of the specs
+    flushes or closes). The call site is compared first, the message is only
+    rendered (no formatting) when it matches.
+
+    The summary is a copy of the last repeat, goes to ``handler`` (or the
+    ``lazylog.dedup`` logger if there is none) and has the count in
+    ``repeated``, so JSON files get it as a field
+    """
 
-        msg = logging.Formatter.format(self, tmp_record)
+    TIMEOUT = 10
+    """Default max seconds repeats wait to be summarized"""
 
-        if self.splitLines and tmp_record.message != "":
-            parts = msg.split(tmp_record.message)
-            msg = msg.replace("\n", "\n" + parts[0])
-        # Escape new lines so the full message is in a single line
-        elif not self.splitLines and msg != "":
-            msg = msg.replace("\n", "\\n")
+    NAME = "lazylog.dedup"
+    """Logger name of the summary records, never deduplicated"""
 
-        # The background is set with 40 plus the number of the color,
-        # and the foreground with 30
-        if self.color and levelname in self.colors:
-            msg = "%s%d;%dm%s%s" % (
-                ColorFormatter.ESC,
-                self.styles[levelname],
-                30 + self.colors[levelname],
-                msg,
-                ColorFormatter.RESET_SEQ,
-            )
-            return msg
+    def __init__(self, timeout=TIMEOUT, handler=None):
+        logging.Filter.__init__(self)
+        self.timeout = timeout
+        self.handler = handler
 
-        return msg
+        # Last record let through, its message once needed, the last repeat
+        # and how many there were
+        self._last = None
+        self._message = None
+        self._repeat = None
+        self._count = 0
+        self._timer = None
+        self._lock = threading.RLock()
 
     @staticmethod
-    def parseSpecs(specs, defaults):
+    def _exception(record):
+        if record.exc_info:
+            return repr(record.exc_info[1])
+        return record.exc_text
+
+    def filter(self, record):
+        if record.name in (self.NAME, RateLimitFilter.NAME):
+            return True
+
+        with self._lock:
+            last = self._last
+            if (
+                last is not None
+                and record.lineno == last.lineno
+                and record.levelno == last.levelno
+                and record.pathname == last.pathname
+            ):
+                if self._message is None:
+                    self._message = last.getMessage()
+                if record.getMessage() == self._message and (
+                    self._exception(record) == self._exception(last)
+                ):
+                    self._repeat = record
+                    self._count += 1
+                    if self._timer is None:
+                        self._timer = threading.Timer(self.timeout, self.flush)
+                        self._timer.daemon = True
+                        self._timer.start()
+                    return False
+
+            self.flush()
+            self._last = record
+            self._message = None
+        return True
+
+    def flush(self):
         """
-        Merge the user specs with the defaults given (terminal or file). Also
-        ensure that if ``pretty`` is set, ``splitLines`` is also set (implied)
+        Write the summary of the pending repeats, if any
         """
-        specs = merge_dicts(specs, defaults.copy())
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._count:
+                return
+
+            summary = copy.copy(self._repeat)
+            summary.name = self.NAME
+            summary.msg = "Last message repeated %d times"
+            summary.args = (self._count,)
+            summary.exc_info = summary.exc_text = summary.stack_info = None
+            summary.repeated = self._count
+            self._repeat = None
+            self._count = 0
+
+            if self.handler is None:
+                logging.getLogger(self.NAME).handle(summary)
+            elif summary.levelno >= self.handler.level:
+                self.handler.handle(summary)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to the background :py:class:`QueueListener` without
+    formatting them. The caller never blocks: if the queue is full the record
+    is dropped and counted in ``dropped``
+    """
 
-        # Pretty overrides split lines
-        specs["pretty"] = specs.get("pretty", False)
-        specs["splitLines"] = specs.get("splitLines", False)
-        if specs["pretty"] and not specs["splitLines"]:
-            specs["splitLines"] = True
+    def __init__(self, queue):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.dropped = 0
 
-        return specs
+    def prepare(self, record):
+        """
+        The record never leaves the process, so it is not formatted here (the
+        default does, to make it picklable). Only what the caller may change
+        before the writer gets to it is taken now: the message is rendered
+        with its ``args``, and dict/list messages are copied, so formatters on
+        the other side still see them as such. :py:class:`Lazy` messages and
+        arguments are left for the writer
+        """
+        msg = record.msg
+        args = record.args
+        if args:
+            lazyArgs = args.values() if isinstance(args, dict) else args
+            if not isinstance(msg, Lazy) and not any(
+                isinstance(arg, Lazy) for arg in lazyArgs
+            ):
+                record.msg = record.getMessage()
+                record.args = None
+        elif type(msg) in (dict, list):
+            record.msg = copy.copy(msg)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
 
 
-class JSONFormatter(logging.Formatter):
+class QueueListener(logging.handlers.QueueListener):
+    """
+    Queue listener that waits for space in a full queue when stopping, rather
+    than failing to deliver the stop signal
     """
-    Format messages as JSON
-
-    Lots of ideas from:
 
-        https://github.com/madzak/python-json-logger/blob/master/src/pythonjsonlogger/jsonlogger.py
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
 
 
+class SharedRing(object):
+    """
+    Ring of length-prefixed messages in shared memory, written by any number
+    of processes forked after it was created and read by the one that created
+    it. A full ring drops the message and counts it in :py:attr:`dropped`
+
+    Python has no atomic operations or memory barriers on shared memory, so
+    the head/tail indexes are only touched while holding a ``multiprocessing``
+    lock, which uncontended is a futex operation in user space (no syscall).
+    A writer holds it for one memcpy, the reader twice per batch of messages
     """
 
-    # http://docs.python.org/library/logging.html#logrecord-attributes
-    RESERVED_ATTRS = (
-        "args",
-        "asctime",
-        "created",
-        "exc_info",
-        "exc_text",
-        "filename",
-        "funcName",
-        "levelname",
-        "levelno",
+    HEADER = struct.Struct("QQQ")
+    """head (bytes written), tail (bytes read), dropped messages"""
+
+    LENGTH = struct.Struct("I")
+
+    def __init__(self, size):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory is not available here")
+
+        self.size = int(size)
+        self.owner = os.getpid()
+        self._lock = multiprocessing.Lock()
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self.HEADER.size + self.size
+        )
+        self._buf = self._shm.buf
+        self._data = self._buf[self.HEADER.size :]
+        self.HEADER.pack_into(self._buf, 0, 0, 0, 0)
+
+    @property
+    def dropped(self):
+        with self._lock:
+            return self.HEADER.unpack_from(self._buf, 0)[2]
+
+    def put(self, data):
+        """
+        Append a message, returns False if it did not fit
+        """
+        data = self.LENGTH.pack(len(data)) + data
+        size = len(data)
+
+        with self._lock:
+            head, tail, dropped = self.HEADER.unpack_from(self._buf, 0)
+            if head - tail + size > self.size:
+                self.HEADER.pack_into(self._buf, 0, head, tail, dropped + 1)
+                return False
+
+            start = head % self.size
+            first = min(size, self.size - start)
+            self._data[start : start + first] = data[:first]
+            if first < size:
+                self._data[: size - first] = data[first:]
+            self.HEADER.pack_into(self._buf, 0, head + size, tail, dropped)
+        return True
+
+    def get(self):
+        """
+        Take all the messages written so far. Reader only
+        """
+        with self._lock:
+            head, tail, _ = self.HEADER.unpack_from(self._buf, 0)
+        if head == tail:
+            return []
+
+        start = tail % self.size
+        end = start + head - tail
+        if end <= self.size:
+            chunk = bytes(self._data[start:end])
+        else:
+            chunk = bytes(self._data[start:]) + bytes(self._data[: end - self.size])
+
+        # Copied out, the space can be reused
+        with self._lock:
+            current, _, dropped = self.HEADER.unpack_from(self._buf, 0)
+            self.HEADER.pack_into(self._buf, 0, current, head, dropped)
+
+        messages = []
+        offset, length = 0, self.LENGTH.size
+        while offset < len(chunk):
+            size = self.LENGTH.unpack_from(chunk, offset)[0]
+            messages.append(chunk[offset + length : offset + length + size])
+            offset += length + size
+        return messages
+
+    def close(self):
+        """
+        Detach, and remove the segment if we created it
+        """
+        self._data.release()
+        self._buf = self._data = None
+        self._shm.close()
+        if os.getpid() == self.owner:
+            self._shm.unlink()
+
+
+class RingHandler(logging.Handler):
+    """
+    Packs records (see :py:meth:`CollectorHandler.pack`) into a
+    :py:class:`SharedRing`. Never blocks, records that do not fit are dropped
+    and counted in ``dropped``
+    """
+
+    def __init__(self, ring):
+        logging.Handler.__init__(self)
+        self.ring = ring
+
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+    def emit(self, record):
+        try:
+            packed = CollectorHandler.pack(record)
+            self.ring.put(CollectorHandler._encode(packed).encode("utf-8"))
+        except Exception:
+            self.handleError(record)
+
+
+class RingListener(object):
+    """
+    Thread draining a :py:class:`SharedRing` into ``handlers`` every
+    :py:attr:`INTERVAL` seconds, or as long as there is something to drain
+    """
+
+    INTERVAL = 0.01
+    """Seconds to wait when the ring is empty"""
+
+    def __init__(self, ring, handlers=(), interval=INTERVAL):
+        self.ring = ring
+        self.handlers = tuple(handlers)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="lazylog-ring")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.drain():
+                self._stop.wait(self.interval)
+
+    def drain(self):
+        """
+        Handle everything in the ring, returns the number of records
+        """
+        with self._lock:
+            messages = self.ring.get()
+            for data in messages:
+                record = CollectorHandler.unpack(json.loads(data.decode("utf-8")))
+                for h in self.handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+        return len(messages)
+
+    def flush(self):
+        if os.getpid() == self.ring.owner:
+            self.drain()
+
+    def stop(self):
+        """
+        Drain what is left, stop the thread and release the ring. Only the
+        creator does it, forked processes leave them alone
+        """
+        if os.getpid() != self.ring.owner:
+            return
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.drain()
+        self.ring.close()
+
+
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotating file handler that can buffer records and write them in batches.
+    With ``bufferSize`` > 1 records are written when the batch is full, when
+    ``flushInterval`` ms have passed or immediately for records at or above
+    ``flushLevel``. Buffered records are always written before rotation, on
+    :py:meth:`flush` and on close (ie: interpreter exit)
+
+    The file size is tracked with a counter of bytes written, so records are
+    formatted once and there is no seek/tell per record. The real size is
+    only checked when the counter says it is time to rotate, which covers
+    files truncated by someone else
+
+    ``rotation`` selects how backups are named:
+
+    - ``cascade``: ``file.1`` is the newest, every rollover renames all of them
+    - ``sequence``: ``file.sN`` with N increasing, the highest is the newest
+    - ``timestamp``: ``file.YYYYmmdd-HHMMSS-micros`` of the rollover time
+
+    The last two cost one rename plus one unlink of the oldest backup per
+    rollover. Their names never clash with the cascade ones, so switching
+    modes leaves the old backups alone. Besides ``backupCount``,
+    ``maxTotalBytes`` limits the total size of the backups, the oldest are
+    removed first
+
+    With ``compress`` set (``gzip``, ``bz2`` or ``lzma``), backups are handed to
+    the :py:class:`Compressor` after rotation. This needs stable backup names,
+    so it is not supported with ``cascade``
+
+    With ``multiprocess`` several processes can share the file. Writes are
+    plain ``O_APPEND`` writes, only the rollover takes an advisory ``flock``
+    on ``<filename>.lock``, so there is no lock per record. A process that
+    finds the file already rotated by another one (different inode) just
+    reopens it. Needs ``fcntl`` (ie: not on Windows)
+
+    With ``index`` a sidecar ``<filename>.idx`` is kept next to the file: one
+    :py:attr:`INDEX` entry per block of ``indexRecords`` records or
+    ``indexBytes`` bytes, whichever comes first (and on :py:meth:`flush`), so
+    readers can jump to a time window (see :py:meth:`readIndex`). It is
+    rotated, compressed or not, together with its file. Not available with
+    ``multiprocess``, offsets would mix the records of several processes
+    """
+
+    FLUSHINTERVAL = 1000
+    """Default max milliseconds a buffered record waits to be written"""
+
+    INDEXRECORDS = 1000
+    """Default max records per index block"""
+
+    INDEXBYTES = 64 * 1024
+    """Default max bytes per index block"""
+
+    INDEX = struct.Struct("!ddQQH")
+    """Index entry: min and max ``created``, start and end offsets, max level"""
+
+    ROTATIONS = {
+        "sequence": r"s\d+",
+        "timestamp": r"\d{8}-\d{6}-\d{6}",
+    }
+    """Backup suffix patterns of the non-cascading rotation modes"""
+
+    def __init__(
+        self,
+        filename,
+        mode="a",
+        maxBytes=0,
+        backupCount=0,
+        encoding=None,
+        delay=False,
+        bufferSize=1,
+        flushInterval=FLUSHINTERVAL,
+        flushLevel=logging.ERROR,
+        fsync=False,
+        rotation="cascade",
+        maxTotalBytes=0,
+        compress=None,
+        multiprocess=False,
+        index=False,
+        indexRecords=INDEXRECORDS,
+        indexBytes=INDEXBYTES,
+    ):
+        if rotation != "cascade" and rotation not in RotatingFileHandler.ROTATIONS:
+            raise RuntimeError('Unknown rotation "%s"' % rotation)
+
+        if compress and compress not in Compressor.METHODS:
+            raise RuntimeError('Unknown compression "%s"' % compress)
+
+        if compress and rotation == "cascade":
+            raise RuntimeError('"compress" needs "sequence" or "timestamp" rotation')
+
+        if multiprocess and fcntl is None:
+            raise RuntimeError('"multiprocess" needs fcntl, not available here')
+
+        if multiprocess and not mode.startswith("a"):
+            raise RuntimeError('"multiprocess" needs an append mode')
+
+        if multiprocess and index:
+            raise RuntimeError('"index" is not supported with "multiprocess"')
+
+        # Bytes in the file and its inode, set in _open()
+        self._size = 0
+        self._opened = None
+        self._ino = None
+        self.multiprocess = multiprocess
+
+        # Current index block [min, max, start, end, level, records] and the
+        # entries waiting for their records to be written
+        self.index = index
+        self.indexRecords = indexRecords
+        self.indexBytes = indexBytes
+        self._block = None
+        self._entries = []
+        self._indexStream = None
+        logging.handlers.RotatingFileHandler.__init__(
+            self, filename, mode, maxBytes, backupCount, encoding, delay
+        )
+        self.bufferSize = max(int(bufferSize), 1)
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self.fsync = fsync
+        self.rotation = rotation
+        self.maxTotalBytes = maxTotalBytes
+        self.compress = compress
+
+        self.rotations = 0
+        self.bytesWritten = 0
+
+        # Oldest first [(path, size), ...], cascade mode does not track them
+        self._backups = None
+        self._backupBytes = 0
+        self._lastBackup = None
+        if self.rotation != "cascade":
+            self._scanBackups()
+
+        self._start()
+
+    def _start(self):
+        """
+        (Re)start in this process. After a fork the buffered records (and the
+        index entries waiting for them) and the flush thread are the parent's
+        """
+        self._pid = os.getpid()
+        self._buffer = []
+        self._pending = 0
+        self._lastSync = time.time()
+        self._block = None
+        self._entries = []
+        self._size = self._realSize(self.stream, self._size)
+
+        self._stopFlush = threading.Event()
+        if self.bufferSize > 1 and self.flushInterval:
+            # Weak reference so that a dropped handler can be collected
+            flusher = threading.Thread(
+                target=RotatingFileHandler._flushLoop,
+                args=(weakref.ref(self), self._stopFlush, self.flushInterval / 1000.0),
+                name="lazylog-flush",
+            )
+            flusher.daemon = True
+            flusher.start()
+
+    @staticmethod
+    def _flushLoop(ref, closed, interval):
+        while not closed.wait(interval):
+            handler = ref()
+            if handler is None:
+                return
+            handler.flush()
+            del handler
+
+    def _open(self):
+        stream = logging.handlers.RotatingFileHandler._open(self)
+        try:
+            st = os.fstat(stream.fileno())
+            self._size, self._ino = st.st_size, st.st_ino
+        except (AttributeError, ValueError, OSError):
+            self._ino = None
+        self._opened = stream
+
+        if self.index and self._size == 0:
+            # New or truncated file, whatever index is there is stale
+            Compressor.remove(self.indexName(self.baseFilename))
+        return stream
+
+    def _followFile(self):
+        """
+        Reopen the file if another process rotated it (the path is gone or is
+        a different inode). Returns True if it was reopened
+        """
+        if self.stream is None or self.stream is not self._opened or self._ino is None:
+            return False
+
+        try:
+            st = os.stat(self.baseFilename)
+        except OSError:
+            st = None
+
+        if st is not None and st.st_ino == self._ino:
+            self._size = st.st_size
+            return False
+
+        self.stream.close()
+        self.stream = self._open()
+        return True
+
+    @staticmethod
+    def _realSize(stream, default):
+        """
+        Size of the file behind ``stream`` or ``default`` if it is not a file
+        (ie: mocked with StringIO)
+        """
+        try:
+            return os.fstat(stream.fileno()).st_size
+        except (AttributeError, ValueError, OSError):
+            return default
+
+    def _encodedLength(self, msg):
+        try:
+            # Not str.isascii(), that is 3.7+
+            return len(msg.encode("ascii"))
+        except UnicodeError:
+            pass
+        return len(
+            msg.encode(getattr(self.stream, "encoding", None) or "utf-8", "replace")
+        )
+
+    def _shouldRollover(self, size):
+        """
+        Check if writing ``size`` more bytes would exceed ``maxBytes``, taking
+        into account what is still buffered
+        """
+        if self.maxBytes <= 0:
+            return False
+
+        if self._size + self._pending + size < self.maxBytes:
+            return False
+
+        # Confirm with the real size, the file may have been truncated
+        if self.stream is None:
+            self.stream = self._open()
+        self._size = self._realSize(self.stream, self._size)
+
+        return self._size + self._pending + size >= self.maxBytes
+
+    def doRollover(self):
+        if not self.multiprocess:
+            self._rollover()
+            return
+
+        fd = os.open(self.baseFilename + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            try:
+                # Same as the log file, other users share it
+                os.fchmod(fd, 0o666)
+            except OSError:
+                pass
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # Somebody else rotated while we waited for the lock
+                if self._followFile():
+                    return
+                if self.rotation != "cascade":
+                    self._scanBackups(recover=False)
+                self._rollover()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _rollover(self):
+        self.rotations += 1
+        self._closeIndex()
+        if self.rotation == "cascade":
+            for i in range(self.backupCount - 1, 0, -1):
+                source = self.rotation_filename("%s.%d" % (self.baseFilename, i))
+                if os.path.exists(source):
+                    self._moveIndex(
+                        source,
+                        self.rotation_filename("%s.%d" % (self.baseFilename, i + 1)),
+                    )
+            logging.handlers.RotatingFileHandler.doRollover(self)
+            if self.maxTotalBytes > 0:
+                self._pruneCascade()
+        else:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+
+            dfn = self._backupName()
+            if os.path.exists(self.baseFilename):
+                self.rotate(self.baseFilename, dfn)
+                self._backups.append((dfn, self._size))
+                self._backupBytes += self._size
+                if self.compress:
+                    Compressor.instance().submit(dfn, self.compress, self._compressed)
+            self._prune()
+
+            if not self.delay:
+                self.stream = self._open()
+
+        if self.stream is None:
+            # Delayed, the new file is opened on the next write
+            self._size = 0
+
+    def rotate(self, source, dest):
+        logging.handlers.RotatingFileHandler.rotate(self, source, dest)
+        self._moveIndex(source, dest)
+
+    @staticmethod
+    def indexName(path):
+        """
+        Index of the log file (or compressed backup) ``path``
+        """
+        for ext, _ in Compressor.METHODS.values():
+            if path.endswith(ext):
+                path = path[: -len(ext)]
+                break
+        return path + ".idx"
+
+    @classmethod
+    def readIndex(cls, path):
+        """
+        Entries ``(min time, max time, start, end, max level)`` of the index
+        of ``path``, oldest first. Empty if there is none. Bytes after the last
+        entry are not indexed (yet)
+        """
+        try:
+            with open(cls.indexName(path), "rb") as f:
+                data = f.read()
+        except OSError:
+            return []
+        size = len(data) - len(data) % cls.INDEX.size
+        return list(cls.INDEX.iter_unpack(data[:size]))
+
+    def _moveIndex(self, source, dest):
+        """
+        Rename the index of ``source`` along with it, the one of ``dest`` is
+        stale either way
+        """
+        try:
+            os.replace(self.indexName(source), self.indexName(dest))
+        except OSError:
+            Compressor.remove(self.indexName(dest))
+
+    def _indexRecord(self, record, size):
+        """
+        Add ``record`` (``size`` bytes, about to be buffered) to the current
+        index block, closing the block once full
+        """
+        block = self._block
+        if block is None:
+            if self.stream is None:
+                # Offsets continue what is already in the file
+                self.stream = self._open()
+            offset = self._size + self._pending
+            block = self._block = [record.created, record.created, offset, offset, 0, 0]
+
+        created = record.created
+        if created < block[0]:
+            block[0] = created
+        elif created > block[1]:
+            block[1] = created
+        block[3] += size
+        if record.levelno > block[4]:
+            block[4] = record.levelno
+        block[5] += 1
+
+        if block[5] >= self.indexRecords or block[3] - block[2] >= self.indexBytes:
+            self._closeBlock()
+
+    def _closeBlock(self):
+        block = self._block
+        if block is not None:
+            self._entries.append(self.INDEX.pack(*block[:4], min(block[4], 0xFFFF)))
+            self._block = None
+
+    def _writeIndex(self):
+        """
+        Write the entries whose records are in the file already
+        """
+        if not self._entries:
+            return
+
+        if self._indexStream is None:
+            path = self.indexName(self.baseFilename)
+            self._indexStream = open(path, "ab")
+            try:
+                # Same permissions as the log file
+                os.chmod(path, stat.S_IMODE(os.stat(self.baseFilename).st_mode))
+            except OSError:
+                pass
+
+        self._indexStream.write(b"".join(self._entries))
+        self._indexStream.flush()
+        self._entries = []
+
+    def _closeIndex(self):
+        """
+        Write the current (maybe partial) block and close the index, all
+        records must be written
+        """
+        if not self.index:
+            return
+        self._closeBlock()
+        self._writeIndex()
+        if self._indexStream is not None:
+            self._indexStream.close()
+            self._indexStream = None
+
+    def _backupName(self):
+        """
+        Name for the next backup in sequence/timestamp mode
+        """
+        if self.rotation == "sequence":
+            last = int(self._lastBackup[1:]) if self._lastBackup else 0
+            suffix = "s%d" % (last + 1)
+        else:
+            suffix = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            # Same microsecond (or clock going back), keep the order
+            if self._lastBackup is not None and suffix <= self._lastBackup:
+                suffix = self._lastBackup[:-6] + "%06d" % (
+                    int(self._lastBackup[-6:]) + 1
+                )
+
+        self._lastBackup = suffix
+        return self.rotation_filename("%s.%s" % (self.baseFilename, suffix))
+
+    def _scanBackups(self, recover=True):
+        """
+        Find existing backups of this mode, ordered oldest first. With
+        ``recover`` leftovers of interrupted compressions are cleaned up and
+        compressed again (skipped on the rescans of multiprocess mode, those
+        may belong to another process at work)
+        """
+        dirname, basename = os.path.split(self.baseFilename)
+        pattern = re.compile(
+            r"\.(%s)(%s)?((?:\.\d+)?\.tmp)?$"
+            % (
+                RotatingFileHandler.ROTATIONS[self.rotation],
+                "|".join(re.escape(ext) for ext, _ in Compressor.METHODS.values()),
+            )
+        )
+
+        found = {}
+        for name in os.listdir(dirname or "."):
+            if not name.startswith(basename + "."):
+                continue
+            match = pattern.match(name, len(basename))
+            if match is None:
+                continue
+
+            key, ext, tmp = match.groups()
+            path = os.path.join(dirname, name)
+            if tmp:
+                # Half-written archive, the original is still there
+                if recover and not Compressor.running(tmp):
+                    Compressor.remove(path)
+                continue
+
+            # A complete archive wins over its (not yet removed) original
+            if key in found:
+                if not ext:
+                    Compressor.remove(path)
+                    continue
+                Compressor.remove(found[key][0])
+
+            try:
+                found[key] = (path, ext, os.path.getsize(path))
+            except OSError:
+                continue
+
+        if self.rotation == "sequence":
+            keys = sorted(found, key=lambda k: int(k[1:]))
+        else:
+            keys = sorted(found)
+        self._backups = collections.deque((found[k][0], found[k][2]) for k in keys)
+        self._backupBytes = sum(size for _, size in self._backups)
+        self._lastBackup = keys[-1] if keys else None
+
+        if self.compress and recover:
+            for k in keys:
+                if not found[k][1]:
+                    Compressor.instance().submit(
+                        found[k][0], self.compress, self._compressed
+                    )
+
+    def _compressed(self, source, archive, size):
+        """
+        Called by the :py:class:`Compressor` when done (``archive`` is None if
+        it failed)
+        """
+        self.acquire()
+        try:
+            for i, (path, oldSize) in enumerate(self._backups):
+                if path == source:
+                    if archive is not None:
+                        self._backups[i] = (archive, size)
+                        self._backupBytes += size - oldSize
+                    return
+        finally:
+            self.release()
+
+        # Pruned while being compressed
+        if archive is not None:
+            Compressor.remove(archive)
+
+    def _prune(self):
+        """
+        Remove the oldest backups until within backupCount and maxTotalBytes
+        """
+        backups = self._backups
+        while backups and (
+            (self.backupCount > 0 and len(backups) > self.backupCount)
+            or (self.maxTotalBytes > 0 and self._backupBytes > self.maxTotalBytes)
+        ):
+            path, size = backups.popleft()
+            self._backupBytes -= size
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            Compressor.remove(self.indexName(path))
+
+    def _pruneCascade(self):
+        """
+        Enforce maxTotalBytes on cascading backups (file.1 is the newest)
+        """
+        total = 0
+        for i in range(1, self.backupCount + 1):
+            path = self.rotation_filename("%s.%d" % (self.baseFilename, i))
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                break
+            if total > self.maxTotalBytes:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                Compressor.remove(self.indexName(path))
+
+    def emit(self, record):
+        """
+        Format once, rotate if needed and buffer (or write) the result
+        """
+        try:
+            if self._pid != os.getpid():
+                self._start()
+
+            msg = self.format(record) + self.terminator
+            size = self._encodedLength(msg)
+
+            if self._shouldRollover(size):
+                self._write()
+                self.doRollover()
+
+            if self.index:
+                self._indexRecord(record, size)
+
+            self._buffer.append(msg)
+            self._pending += size
+            self.bytesWritten += size
+
+            if (
+                len(self._buffer) >= self.bufferSize
+                or record.levelno >= self.flushLevel
+            ):
+                self._write()
+                self._sync()
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        """
+        Write the buffer as a single chunk. Caller must hold the lock
+        """
+        if not self._buffer:
+            return
+
+        if self.stream is None:
+            self.stream = self._open()
+        elif self.multiprocess:
+            self._followFile()
+
+        self.stream.write("".join(self._buffer))
+        self.stream.flush()
+        self._size += self._pending
+        self._buffer = []
+        self._pending = 0
+        if self._entries:
+            self._writeIndex()
+
+    def _sync(self):
+        """
+        fsync according to the policy: never, always or at most every N sec
+        """
+        if not self.fsync or self.stream is None:
+            return
+
+        now = time.time()
+        if self.fsync is True or now - self._lastSync >= self.fsync:
+            os.fsync(self.stream.fileno())
+            self._lastSync = now
+
+    def flush(self):
+        """
+        Write anything buffered and flush the stream
+        """
+        self.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._start()
+            if self._buffer:
+                self._write()
+                self._sync()
+            elif self.stream is not None and hasattr(self.stream, "flush"):
+                self.stream.flush()
+            if self._block is not None:
+                # Readers see everything written as indexed
+                self._closeBlock()
+                self._writeIndex()
+        finally:
+            self.release()
+
+    def close(self):
+        self._stopFlush.set()
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.flush()
+            self._closeIndex()
+        finally:
+            self.release()
+        logging.handlers.RotatingFileHandler.close(self)
+
+
+class CollectorHandler(logging.Handler):
+    """
+    Sends records to a collector (``python -m lazylog.collector``) over its
+    Unix socket, which does all the formatting and writing. Records are
+    packed (message rendered, exception as text) and sent in batches with the
+    same ``bufferSize``/``flushInterval``/``flushLevel`` rules as
+    :py:class:`RotatingFileHandler`
+
+    If the collector is not there, or goes away, records are handed to the
+    handlers returned by ``fallback()`` (called once, when first needed) and
+    the socket is retried every :py:attr:`RETRY` seconds
+    """
+
+    BUFFERSIZE = 100
+    """Default number of records sent together"""
+
+    RETRY = 5
+    """Seconds between attempts to reach a missing collector"""
+
+    TIMEOUT = 1.0
+    """Max seconds a send may block before giving up on the collector"""
+
+    PACKED = (
+        "name",
+        "levelno",
+        "levelname",
+        "pathname",
+        "lineno",
+        "funcName",
+        "created",
+        "msecs",
+        "relativeCreated",
+        "process",
+        "processName",
+        "thread",
+        "threadName",
+    )
+    """Record attributes sent, in this order. Then the message, exception,
+    stack and extras"""
+
+    HEADER = struct.Struct("!I")
+    """Frame header: length of the JSON batch that follows"""
+
+    JSONTYPES = frozenset((type(None), bool, int, float, str))
+    """Types that come back the same from JSON"""
+
+    DEPTH = 32
+    """Deepest message object sent as it is, deeper ones are rendered"""
+
+    _formatter = logging.Formatter()
+    _fields = operator.itemgetter(*PACKED)
+    _encode = json.JSONEncoder(separators=(",", ":"), default=str).encode
+
+    def __init__(
+        self,
+        path,
+        bufferSize=BUFFERSIZE,
+        flushInterval=RotatingFileHandler.FLUSHINTERVAL,
+        flushLevel=logging.ERROR,
+        fallback=None,
+    ):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.bufferSize = max(int(bufferSize), 1)
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self.fallback = fallback
+        self._fallbackHandlers = None
+        self._sock = None
+        self._stopFlush = None
+        self._start()
+
+    def _start(self):
+        """
+        (Re)start in this process. After a fork the socket, buffer and flush
+        thread of the parent are not ours
+        """
+        self._pid = os.getpid()
+        self._sock = None
+        self._retryAt = 0
+        self._buffer = []
+
+        self._stopFlush = threading.Event()
+        if self.bufferSize > 1 and self.flushInterval:
+            flusher = threading.Thread(
+                target=RotatingFileHandler._flushLoop,
+                args=(weakref.ref(self), self._stopFlush, self.flushInterval / 1000.0),
+                name="lazylog-flush",
+            )
+            flusher.daemon = True
+            flusher.start()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def _connect(self):
+        if time.time() < self._retryAt:
+            return None
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.TIMEOUT)
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            self._retryAt = time.time() + self.RETRY
+            return None
+
+        self._sock = sock
+        return sock
+
+    @staticmethod
+    def pack(record):
+        """
+        Turn ``record`` into a JSON-able list, see :py:attr:`PACKED`
+        """
+        values = record.__dict__
+        try:
+            packed = list(CollectorHandler._fields(values))
+        except KeyError:
+            packed = [values.get(k) for k in CollectorHandler.PACKED]
+
+        # Dicts/lists are kept for pretty/JSON formatting on the other side,
+        # unless they would not come back the same (tuples, dates...)
+        msg = Lazy.resolve(record.msg)
+        if (
+            isinstance(msg, str_types)
+            or record.args
+            or not CollectorHandler._exact(msg)
+        ):
+            msg = record.getMessage()
+
+        exc = record.exc_text
+        if record.exc_info and not exc:
+            exc = CollectorHandler._formatter.formatException(record.exc_info)
+
+        packed += [msg, exc, record.stack_info, _extras(values)]
+        return packed
+
+    @staticmethod
+    def _exact(value, depth=DEPTH):
+        """
+        Check that ``value`` comes back the same from JSON: only dicts with
+        str keys, lists, str, int, float, bool and None
+        """
+        kind = type(value)
+        if kind in CollectorHandler.JSONTYPES:
+            return True
+        if depth == 0:
+            return False
+        if kind is dict:
+            exact = CollectorHandler._exact
+            return all(type(k) is str and exact(v, depth - 1) for k, v in value.items())
+        if kind is list:
+            return all(CollectorHandler._exact(v, depth - 1) for v in value)
+        return False
+
+    @staticmethod
+    def unpack(packed):
+        """
+        Rebuild a LogRecord from :py:meth:`pack`
+        """
+        n = len(CollectorHandler.PACKED)
+        values = packed[n + 3] or {}
+        values.update(zip(CollectorHandler.PACKED, packed))
+        values["msg"], values["exc_text"], values["stack_info"] = packed[n : n + 3]
+
+        pathname = values["pathname"] or ""
+        values["filename"] = os.path.basename(pathname)
+        values["module"] = os.path.splitext(values["filename"])[0]
+        return logging.makeLogRecord(values)
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._start()
+
+            self._buffer.append(self.pack(record))
+            if (
+                len(self._buffer) >= self.bufferSize
+                or record.levelno >= self.flushLevel
+            ):
+                self._send()
+        except Exception:
+            self.handleError(record)
+
+    def _send(self):
+        """
+        Send the buffer as one frame, or hand it to the fallback handlers.
+        Caller must hold the lock
+        """
+        if not self._buffer:
+            return
+
+        batch, self._buffer = self._buffer, []
+        sock = self._sock or self._connect()
+        if sock is not None:
+            data = self._encode(batch).encode("utf-8")
+            try:
+                sock.sendall(self.HEADER.pack(len(data)) + data)
+                return
+            except OSError:
+                # The collector drops a partial frame, write it all locally
+                sock.close()
+                self._sock = None
+                self._retryAt = time.time() + self.RETRY
+
+        self._toFallback(batch)
+
+    def _toFallback(self, batch):
+        if self._fallbackHandlers is None:
+            self._fallbackHandlers = list(self.fallback()) if self.fallback else []
+
+        for packed in batch:
+            record = self.unpack(packed)
+            for h in self._fallbackHandlers:
+                if record.levelno >= h.level:
+                    h.handle(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._pid == os.getpid():
+                self._send()
+            for h in self._fallbackHandlers or ():
+                h.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self._stopFlush.set()
+        self.acquire()
+        try:
+            self.flush()
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+            for h in self._fallbackHandlers or ():
+                h.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class BinaryFileHandler(RotatingFileHandler):
+    """
+    Writes records as packed frames instead of text, nothing is formatted.
+    Render them later with ``python -m lazylog.render``.
+
+    Call sites (logger, level, file, line, function and format string) and
+    contexts (process and thread ids and names) are written once per file
+    and then referred to by id, so a record is just two ids, the time and
+    the message arguments. A file is :py:attr:`MAGIC` followed by frames of
+    kind (one byte), length (varint) and payload:
+
+    - ``SITE``: id, call site as JSON
+    - ``CONTEXT``: id, ``[process, processName, thread, threadName]`` as JSON
+    - ``RECORD``: site id, context id, ``created`` (double), number of
+      arguments, then the arguments, exception text, stack and extras as
+      values (see :py:meth:`packValue`)
+
+    Integers (ids, lengths and int values) are varints. Arguments are only
+    kept when they are all :py:attr:`PRIMITIVES`, which render the same
+    later. Otherwise (ie: ``%r`` of a ``Path``) the rendered message is
+    stored instead, as a site without format string
+    """
+
+    MAGIC = b"LZLB\x01"
+    """Start of every file, with the format version"""
+
+    SITE, CONTEXT, RECORD = 1, 2, 3
+
+    MAPPING = 255
+    """Number of arguments meaning a single mapping (``%(key)s`` formats)"""
+
+    PRIMITIVES = frozenset((type(None), bool, int, float, str, bytes))
+    """Types of the arguments (and message objects' items) kept as they are"""
+
+    DEPTH = 32
+    """Deepest message object kept as it is, deeper ones are rendered"""
+
+    FLOAT = struct.Struct("!d")
+
+    def __init__(self, filename, *args, **kwargs):
+        if kwargs.get("multiprocess"):
+            raise RuntimeError('"binary" files cannot be shared by processes')
+
+        if kwargs.get("index"):
+            raise RuntimeError(
+                '"binary" files have no index, tables are needed from the start'
+            )
+
+        delay = kwargs.get("delay", False)
+        kwargs["delay"] = True
+        self._sites = {}
+        self._contexts = {}
+        RotatingFileHandler.__init__(self, filename, *args, **kwargs)
+
+        # The stdlib forces "a" when there is a maxBytes, and an encoding
+        self.mode = "ab"
+        self.encoding = None
+        self.errors = None
+        self.terminator = b""
+        if not delay:
+            self.stream = self._open()
+
+    def _open(self):
+        stream = RotatingFileHandler._open(self)
+
+        # Every file has its own tables
+        self._sites = {}
+        self._contexts = {}
+        if self._size == 0:
+            stream.write(self.MAGIC)
+            stream.flush()
+            self._size = len(self.MAGIC)
+        return stream
+
+    @staticmethod
+    def varint(n):
+        """
+        Unsigned LEB128
+        """
+        if n < 0x80:
+            return bytes((n,))
+        if n < 0x4000:
+            return bytes(((n & 0x7F) | 0x80, n >> 7))
+        out = bytearray()
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+        return bytes(out)
+
+    @staticmethod
+    def readVarint(data, offset):
+        """
+        Returns the varint at ``offset`` and the next offset
+        """
+        n = shift = 0
+        while True:
+            b = data[offset]
+            offset += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return n, offset
+            shift += 7
+
+    def _frame(self, kind, payload):
+        return bytes((kind,)) + self.varint(len(payload)) + payload
+
+    def _define(self, table, kind, key, value, out):
+        """
+        Add ``key`` to ``table`` and write its definition, returns its id
+        """
+        sid = table[key] = len(table)
+        data = CollectorHandler._encode(value).encode("utf-8")
+        out.append(self._frame(kind, self.varint(sid) + data))
+        return sid
+
+    @staticmethod
+    def packValue(value, out):
+        """
+        Append ``value`` to ``out`` as a type tag and its packed value: None,
+        bool, int (zigzag varint), float, str, bytes, and dict, list and
+        tuple item by item. Anything else is written as ``str(value)``
+        """
+        kind = type(value)
+        if value is None:
+            out.append(b"n")
+        elif kind is bool:
+            out.append(b"t" if value else b"f")
+        elif kind is int:
+            out.append(
+                b"i"
+                + BinaryFileHandler.varint(
+                    value << 1 if value >= 0 else (~value << 1) | 1
+                )
+            )
+        elif kind is float:
+            out.append(b"d" + BinaryFileHandler.FLOAT.pack(value))
+        elif kind is dict:
+            out.append(b"m" + BinaryFileHandler.varint(len(value)))
+            for k, v in value.items():
+                BinaryFileHandler.packValue(k, out)
+                BinaryFileHandler.packValue(v, out)
+        elif kind is list or kind is tuple:
+            out.append(
+                (b"l" if kind is list else b"u") + BinaryFileHandler.varint(len(value))
+            )
+            for v in value:
+                BinaryFileHandler.packValue(v, out)
+        else:
+            if kind is bytes:
+                tag, data = b"b", value
+            else:
+                tag, data = b"s", str(value).encode("utf-8", "replace")
+            out.append(tag + BinaryFileHandler.varint(len(data)) + data)
+
+    @staticmethod
+    def unpackValue(data, offset):
+        """
+        Read a value of :py:meth:`packValue`, returns it and the next offset
+        """
+        tag = data[offset]
+        offset += 1
+        if tag == 0x6E:  # n
+            return None, offset
+        if tag in (0x74, 0x66):  # t, f
+            return tag == 0x74, offset
+        if tag == 0x69:  # i
+            n, offset = BinaryFileHandler.readVarint(data, offset)
+            return (n >> 1) ^ -(n & 1), offset
+        if tag == 0x64:  # d
+            return BinaryFileHandler.FLOAT.unpack_from(data, offset)[0], offset + 8
+
+        size, offset = BinaryFileHandler.readVarint(data, offset)
+        if tag == 0x6D:  # m
+            value = {}
+            for _ in range(size):
+                k, offset = BinaryFileHandler.unpackValue(data, offset)
+                value[k], offset = BinaryFileHandler.unpackValue(data, offset)
+            return value, offset
+        if tag in (0x6C, 0x75):  # l, u
+            value = []
+            for _ in range(size):
+                v, offset = BinaryFileHandler.unpackValue(data, offset)
+                value.append(v)
+            return (value if tag == 0x6C else tuple(value)), offset
+
+        value = data[offset : offset + size]
+        if tag != 0x62:  # b
+            value = value.decode("utf-8", "replace")
+        return value, offset + size
+
+    @staticmethod
+    def _exact(value, depth=DEPTH):
+        """
+        Check that ``value`` only holds :py:attr:`PRIMITIVES`, dicts, lists
+        and tuples, so it comes back the same from :py:meth:`packValue`
+        """
+        kind = type(value)
+        if kind in BinaryFileHandler.PRIMITIVES:
+            return True
+        if depth == 0:
+            return False
+        if kind is dict:
+            exact = BinaryFileHandler._exact
+            return all(
+                exact(k, depth - 1) and exact(v, depth - 1) for k, v in value.items()
+            )
+        if kind is list or kind is tuple:
+            return all(BinaryFileHandler._exact(v, depth - 1) for v in value)
+        return False
+
+    def _args(self, args):
+        """
+        The resolved arguments if they can be kept as they are, else None
+        """
+        primitives = self.PRIMITIVES
+        if isinstance(args, (tuple, list)):
+            args = [Lazy.resolve(arg) for arg in args]
+            values = args
+        else:
+            args = dict(args)
+            values = args.values()
+            if not all(type(k) is str for k in args):
+                return None
+
+        for value in values:
+            if type(value) not in primitives:
+                return None
+        return args
+
+    def format(self, record):
+        """
+        Pack ``record``, preceded by the definitions it needs
+        """
+        out = []
+        msg = Lazy.resolve(record.msg)
+        args = record.args or ()
+        if isinstance(msg, str_types) and len(args) < self.MAPPING:
+            fmt = msg
+            args = self._args(args)
+        else:
+            fmt = args = None
+
+        if args is None:
+            # Objects (dicts, lists...) are kept as the only argument, or
+            # rendered like anything that would not come back the same
+            fmt = None
+            if record.args or not self._exact(msg):
+                msg = record.getMessage()
+            args = (msg,)
+
+        key = (
+            record.name,
+            record.levelno,
+            record.pathname,
+            record.lineno,
+            record.funcName,
+            fmt,
+        )
+        site = self._sites.get(key)
+        if site is None:
+            site = {
+                "name": record.name,
+                "levelno": record.levelno,
+                "levelname": record.levelname,
+                "pathname": record.pathname,
+                "lineno": record.lineno,
+                "funcName": record.funcName,
+                "msg": fmt,
+            }
+            site = self._define(self._sites, self.SITE, key, site, out)
+
+        key = (record.process, record.thread, record.threadName)
+        context = self._contexts.get(key)
+        if context is None:
+            value = (
+                record.process,
+                record.processName,
+                record.thread,
+                record.threadName,
+            )
+            context = self._define(self._contexts, self.CONTEXT, key, value, out)
+
+        body = [
+            self.varint(site),
+            self.varint(context),
+            self.FLOAT.pack(record.created),
+        ]
+        if isinstance(args, (tuple, list)):
+            body.append(bytes((len(args),)))
+            packValue = self.packValue
+            for arg in args:
+                packValue(arg, body)
+        else:
+            body.append(bytes((self.MAPPING,)))
+            self.packValue(args, body)
+
+        exc = record.exc_text
+        if record.exc_info and not exc:
+            exc = CollectorHandler._formatter.formatException(record.exc_info)
+        extra = _extras(record.__dict__)
+
+        if exc is None and record.stack_info is None and extra is None:
+            # The usual: no exception, stack or extras
+            body.append(b"nnn")
+        else:
+            self.packValue(exc, body)
+            self.packValue(record.stack_info, body)
+            self.packValue(extra, body)
+
+        body = b"".join(body)
+        out.append(bytes((self.RECORD,)) + self.varint(len(body)) + body)
+        return b"".join(out)
+
+    @classmethod
+    def records(cls, f):
+        """
+        Read the LogRecords of a binary file opened as ``f``. A truncated last
+        frame (ie: the writer was killed) is ignored
+        """
+        data = f.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("Not a lazylog binary file")
+
+        sites = {}
+        contexts = {}
+        offset = len(cls.MAGIC)
+        while offset < len(data):
+            kind = data[offset]
+            try:
+                size, start = cls.readVarint(data, offset + 1)
+            except IndexError:
+                return
+            offset = start + size
+            if offset > len(data):
+                return
+
+            payload = data[start:offset]
+            if kind == cls.RECORD:
+                yield cls._unpackRecord(payload, sites, contexts)
+            elif kind in (cls.SITE, cls.CONTEXT):
+                sid, pos = cls.readVarint(payload, 0)
+                table = sites if kind == cls.SITE else contexts
+                table[sid] = json.loads(payload[pos:].decode("utf-8"))
+
+    @classmethod
+    def _unpackRecord(cls, payload, sites, contexts):
+        site, offset = cls.readVarint(payload, 0)
+        context, offset = cls.readVarint(payload, offset)
+        created = cls.FLOAT.unpack_from(payload, offset)[0]
+        nargs = payload[offset + 8]
+        offset += 9
+
+        if nargs == cls.MAPPING:
+            args, offset = cls.unpackValue(payload, offset)
+        else:
+            args = []
+            for _ in range(nargs):
+                value, offset = cls.unpackValue(payload, offset)
+                args.append(value)
+            args = tuple(args)
+        exc, offset = cls.unpackValue(payload, offset)
+        stack, offset = cls.unpackValue(payload, offset)
+        extra, offset = cls.unpackValue(payload, offset)
+
+        values = extra or {}
+        values.update(sites[site])
+        if values["msg"] is None:
+            values["msg"], args = args[0], ()
+        values["args"] = args
+        values["filename"] = os.path.basename(values["pathname"] or "")
+        values["module"] = os.path.splitext(values["filename"])[0]
+        values["created"] = created
+        values["msecs"] = (created - int(created)) * 1000
+        (
+            values["process"],
+            values["processName"],
+            values["thread"],
+            values["threadName"],
+        ) = contexts[context]
+        values["exc_text"] = exc
+        values["stack_info"] = stack
+        return logging.makeLogRecord(values)
+
+    def emit(self, record):
+        """
+        Same as :py:meth:`RotatingFileHandler.emit` but packed again after a
+        rollover, the new file starts with empty tables
+        """
+        try:
+            if self._pid != os.getpid():
+                self._start()
+
+            msg = self.format(record)
+            if self._shouldRollover(len(msg)):
+                self._write()
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+                msg = self.format(record)
+
+            self._buffer.append(msg)
+            self._pending += len(msg)
+            self.bytesWritten += len(msg)
+
+            if (
+                len(self._buffer) >= self.bufferSize
+                or record.levelno >= self.flushLevel
+            ):
+                self._write()
+                self._sync()
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        if not self._buffer:
+            return
+
+        if self.stream is None:
+            self.stream = self._open()
+
+        self.stream.write(b"".join(self._buffer))
+        self.stream.flush()
+        self._size += self._pending
+        self._buffer = []
+        self._pending = 0
+
+
+class Compressor(object):
+    """
+    Compresses rotated files in the background. Jobs are queued and handled
+    by at most ``workers`` daemon threads, so logging never waits for them.
+
+    Archives are written to a ``.<pid>.tmp`` file that is renamed when complete and
+    only then is the original removed: an interrupted job leaves the original
+    and maybe a ``.tmp`` behind, never a truncated archive
+    """
+
+    WORKERS = 1
+    """Default number of compression threads"""
+
+    METHODS = {
+        "gzip": (".gz", lambda f: gzip.GzipFile(fileobj=f, mode="wb")),
+        "bz2": (".bz2", lambda f: bz2.BZ2File(f, "wb")),
+    }
+    """Supported methods: name -> (extension, writer factory)"""
+
+    if lzma is not None:
+        METHODS["lzma"] = (".xz", lambda f: lzma.LZMAFile(f, "wb"))
+
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self._start()
+
+    def _start(self):
+        """
+        (Re)start in this process. After a fork the workers of the parent are
+        gone and its jobs are its own (it compresses them)
+        """
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """
+        The compressor shared by all handlers
+        """
+        with cls._instanceLock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def submit(self, path, method, callback=None):
+        """
+        Queue ``path`` for compression. ``callback(path, archive, size)`` is
+        called from the worker when done
+        """
+        if self._pid != os.getpid():
+            self._start()
+
+        self._queue.put((path, method, callback))
+
+        with self._lock:
+            if len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, name="lazylog-compress")
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def join(self):
+        """
+        Block until all queued files have been compressed
+        """
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path, method, callback = self._queue.get()
+            try:
+                try:
+                    archive, size = Compressor.compress(path, method)
+                except Exception:
+                    # The original stays and is retried on the next start
+                    archive, size = None, 0
+
+                if callback is not None:
+                    callback(path, archive, size)
+            except Exception:
+                pass
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def compress(path, method):
+        """
+        Compress ``path`` with ``method`` and remove it. Returns the archive
+        path and size
+        """
+        ext, writer = Compressor.METHODS[method]
+        archive = path + ext
+        tmp = "%s.%d.tmp" % (archive, os.getpid())
+
+        try:
+            with open(path, "rb") as fin:
+                with open(tmp, "wb") as raw:
+                    with writer(raw) as fout:
+                        shutil.copyfileobj(fin, fout, 1024 * 1024)
+                    raw.flush()
+                    os.fsync(raw.fileno())
+            os.rename(tmp, archive)
+        except BaseException:
+            Compressor.remove(tmp)
+            raise
+
+        Compressor.remove(path)
+        return archive, os.path.getsize(archive)
+
+    @staticmethod
+    def running(tmp):
+        """
+        Check if the process that writes ``tmp`` (``archive.<pid>.tmp``) is
+        still running
+        """
+        pid = tmp[1:-4]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class TimestampCache(object):
+    """
+    Renders record times once per second: records of the same second (the
+    common case under load) reuse the text and only differ in milliseconds,
+    which the caller adds (ie: ``%(asctime)s.%(msecs)03d``). Also renders
+    ISO-8601 with milliseconds and UTC offset. The converter is given on each
+    call, so a formatter's ``converter`` can be replaced (ie: ``time.gmtime``)
+    """
+
+    ISOFORMAT = "%Y-%m-%dT%H:%M:%S"
+    """ISO-8601 up to the seconds"""
+
+    def __init__(self):
+        # (second, converter, datefmt, text) and (second, converter, text,
+        # offset), replaced as a whole so threads always see a consistent entry
+        self._text = (None, None, None, None)
+        self._iso = (None, None, None, None)
+
+    def strftime(self, created, datefmt, converter=time.localtime):
+        second = int(created)
+        last, conv, fmt, text = self._text
+        if second != last or conv is not converter or fmt != datefmt:
+            text = time.strftime(datefmt, converter(second))
+            self._text = (second, converter, datefmt, text)
+        return text
+
+    def iso(self, created, msecs, converter=time.localtime):
+        """
+        ie: ``2018-05-08T21:40:16.943+01:00``
+        """
+        second = int(created)
+        last, conv, text, offset = self._iso
+        if second != last or conv is not converter:
+            ct = converter(second)
+            text = time.strftime(self.ISOFORMAT, ct)
+            minutes = (getattr(ct, "tm_gmtoff", None) or 0) // 60
+            sign = "-" if minutes < 0 else "+"
+            offset = "%s%02d:%02d" % (sign, abs(minutes) // 60, abs(minutes) % 60)
+            self._iso = (second, converter, text, offset)
+        return "%s.%03d%s" % (text, msecs, offset)
+
+
+class ColorFormatter(logging.Formatter):
+    """
+    Color formatter. This class is working as expected atm but it can
+    be tidied up to support blinking text and other useless features :)
+
+    The uncolored text of the last record of each thread is kept by format
+    settings, so handlers with equivalent formatters (ie: console and files
+    with the same ``fmt``) render each record once and only add their colors.
+    A record whose ``msg``, ``args`` or ``levelno`` was replaced since (ie: by
+    a handler's filter), or a copy of it, is rendered again
+    """
+
+    BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
+    """ Bash Colors """
+
+    NORM, BOLD, UNK, ITAL, UNDER, BLINK, UNK2, INV, CON = range(9)
+    """ Bash Styles """
+
+    ESC = "\033["
+    """Escape sequence for color"""
+    COLOR_SEQ = "\033[1;%dm"
+    """Escape seq. + color integer placeholder"""
+    RESET_SEQ = "\033[0m"
+    """Reset color sequence"""
+
+    TERMDEFAULTS = {
+        "color": True,
+        "splitLines": True,
+        "level": logging.DEBUG,
+        "pretty": True,
+        "maxDepth": None,
+        "maxItems": None,
+        "maxChars": None,
+    }
+    """Terminal default settings"""
+
+    FILEDEFAULTS = {
+        "color": False,
+        "splitLines": True,
+        "level": logging.INFO,
+        "pretty": False,
+        "maxDepth": None,
+        "maxItems": None,
+        "maxChars": None,
+    }
+    """File default settings"""
+
+    STYLES = {
+        "DEBUG": NORM,
+        "INFO": NORM,
+        "WARNING": NORM,
+        "CRITICAL": BOLD,
+        "ERROR": BOLD,
+    }
+    """Each log-level's default character style"""
+
+    FIELD = re.compile(r"%\((\w+)\)([-#0 +]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa])")
+    """A record attribute in a %-style format, with its conversion"""
+
+    CACHED = frozenset(
+        (
+            "name",
+            "levelname",
+            "levelno",
+            "pathname",
+            "filename",
+            "module",
+            "lineno",
+            "funcName",
+            "thread",
+            "threadName",
+            "process",
+            "processName",
+        )
+    )
+    """Attributes with few distinct (hashable) values, rendered once each"""
+
+    COLORS = {
+        "DEBUG": WHITE,
+        "INFO": CYAN,
+        "WARNING": YELLOW,
+        "CRITICAL": YELLOW,
+        "ERROR": RED,
+    }
+    """Default color values for each log-level"""
+
+    # (weakref to the record, msg, args, levelno, {signature: text}) per thread
+    _rendered = threading.local()
+
+    def __init__(
+        self,
+        fmt,
+        datefmt=None,
+        color=True,
+        splitLines=True,
+        pretty=False,
+        colors=None,
+        styles=None,
+        maxDepth=None,
+        maxItems=None,
+        maxChars=None,
+    ):
+        """
+        Init given the log line format, color and date format. The ``max*``
+        limits are passed to :py:func:`pretty`
+        """
+        logging.Formatter.__init__(self, fmt, datefmt)
+        self.color = color
+        self.splitLines = splitLines
+        self.pretty = pretty
+        self.maxDepth = maxDepth
+        self.maxItems = maxItems
+        self.maxChars = maxChars
+
+        self.colors = colors if colors is not None else ColorFormatter.COLORS
+        self.styles = styles if styles is not None else ColorFormatter.STYLES
+
+        # Escape sequence that opens each level's color, computed once
+        self._colorSeqs = {}
+        for levelname, color in self.colors.items():
+            self._colorSeqs[levelname] = "%s%d;%dm" % (
+                ColorFormatter.ESC,
+                self.styles.get(levelname, ColorFormatter.NORM),
+                30 + color,
+            )
+
+        # Split the format around the message, so the preamble repeated on
+        # every line is rendered once (and not searched for). Other formats
+        # (ie: "%(message)-20s") fall back to the generic path
+        self._head = self._tail = None
+        if "%(message)s" in self._fmt:
+            self._head, _, self._tail = self._fmt.partition("%(message)s")
+            self._renderHead = ColorFormatter.compile(self._head)
+            self._renderTail = ColorFormatter.compile(self._tail)
+
+        self._times = TimestampCache()
+
+        # What the uncolored text depends on, pretty options only matter for
+        # structures. The converter is added on format, it may be replaced
+        self._signature = (type(self), self._fmt, self.datefmt, self.splitLines)
+        self._prettySignature = self._signature + (maxDepth, maxItems, maxChars)
+
+    def format(self, record):
+        """
+        Override format function
+        """
+        levelname = record.levelname
+
+        # Keep reference and copy only if required
+        tmp_record = record
+        raw = Lazy.resolve(record.msg)
+        signature = self._signature
+
+        # NOTE: `message` is formatted, `msg` is raw
+        if self.pretty and (
+            isinstance(raw, dict) or isinstance(raw, tuple) or isinstance(raw, list)
+        ):
+            signature = self._prettySignature
+            tmp_record = None
+
+        signature = (signature, self.converter)
+        cache = ColorFormatter._renderedFor(record)
+        msg = cache.get(signature)
+        if msg is None:
+            if tmp_record is None:
+                # Copy so we do not modify the original message
+                tmp_record = copy.copy(record)
+                tmp_record.msg = pretty(
+                    raw,
+                    maxDepth=self.maxDepth,
+                    maxItems=self.maxItems,
+                    maxChars=self.maxChars,
+                )
+
+            if self._head is None:
+                msg = self._formatGeneric(tmp_record)
+            else:
+                msg = self._formatFast(tmp_record)
+            cache[signature] = msg
+
+        # The background is set with 40 plus the number of the color,
+        # and the foreground with 30
+        if self.color and levelname in self._colorSeqs:
+            return self._colorSeqs[levelname] + msg + ColorFormatter.RESET_SEQ
+
+        return msg
+
+    @staticmethod
+    def _renderedFor(record):
+        """
+        Texts already rendered for ``record`` in this thread, by signature.
+        Handlers get a record one after the other, so only the last one is
+        kept, and only while its message and level are the same objects
+        """
+        rendered = ColorFormatter._rendered
+        last = getattr(rendered, "last", None)
+        if (
+            last is not None
+            and last[0]() is record
+            and last[1] is record.msg
+            and last[2] is record.args
+            and last[3] == record.levelno
+        ):
+            return last[4]
+
+        cache = {}
+        rendered.last = (
+            weakref.ref(record),
+            record.msg,
+            record.args,
+            record.levelno,
+            cache,
+        )
+        return cache
+
+    def formatTime(self, record, datefmt=None):
+        """
+        Same as :py:meth:`logging.Formatter.formatTime`, with strftime once
+        per second (see :py:class:`TimestampCache`)
+        """
+        if datefmt:
+            return self._times.strftime(record.created, datefmt, self.converter)
+
+        text = self._times.strftime(
+            record.created, self.default_time_format, self.converter
+        )
+        if self.default_msec_format:
+            text = self.default_msec_format % (text, record.msecs)
+        return text
+
+    def _formatFast(self, record):
+        """
+        Format with the pre-split format: the preamble is rendered once and
+        re-used as the prefix of every line
+        """
+        record.message = record.getMessage()
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+
+        values = record.__dict__
+        head = self._renderHead(values)
+        msg = head + record.message
+        if self._tail:
+            msg += self._renderTail(values)
+
+        msg = self._appendException(record, msg)
+
+        if self.splitLines and record.message != "":
+            msg = msg.replace("\n", "\n" + head)
+        # Escape new lines so the full message is in a single line
+        elif not self.splitLines and msg != "":
+            msg = msg.replace("\n", "\\n")
+
+        return msg
+
+    @staticmethod
+    def compile(fmt):
+        """
+        Turn a %-style format into a function of ``record.__dict__`` giving
+        the same text as ``fmt % values``, without parsing ``fmt`` every time.
+        Padded or truncated standard attributes (ie: ``%(levelname)-8s``,
+        ``%(module)15.15s``) are rendered once per value and cached. Formats
+        it does not understand keep using ``%``
+        """
+        lines = ["def render(v):"]
+        parts = []
+        scope = {}
+        pos = 0
+        for m in ColorFormatter.FIELD.finditer(fmt):
+            literal = fmt[pos : m.start()]
+            pos = m.end()
+            if "%" in literal.replace("%%", ""):
+                return fmt.__mod__
+            if literal:
+                parts.append(repr(literal.replace("%%", "%")))
+
+            name, spec = m.group(1), m.group(2)
+            var = "x%d" % len(lines)
+            lines.append("    %s = v[%r]" % (var, name))
+            if spec == "s":
+                parts.append("str(%s)" % var)
+            elif name in ColorFormatter.CACHED:
+                cache = {}
+                if name == "levelname":
+                    # Known up front
+                    for levelname in logging._levelToName.values():
+                        cache[levelname] = ("%" + spec) % (levelname,)
+                scope["c" + var] = cache
+                scope["f" + var] = ColorFormatter._cacheFormat("%" + spec, cache)
+                parts.append("(c{0}.get({0}) or f{0}({0}))".format(var))
+            else:
+                parts.append("%r %% (%s,)" % ("%" + spec, var))
+
+        literal = fmt[pos:]
+        if "%" in literal.replace("%%", ""):
+            return fmt.__mod__
+        if literal:
+            parts.append(repr(literal.replace("%%", "%")))
+
+        lines.append(
+            '    return "".join((%s,))' % ", ".join(parts) if parts else '    return ""'
+        )
+        exec("\n".join(lines), scope)
+        return scope["render"]
+
+    @staticmethod
+    def _cacheFormat(spec, cache, limit=1000):
+        """
+        Render ``spec % value`` and keep it in ``cache`` (cleared when it
+        holds ``limit`` values, ie: many thread names)
+        """
+
+        def render(value):
+            text = spec % (value,)
+            if len(cache) >= limit:
+                cache.clear()
+            cache[value] = text
+            return text
+
+        return render
+
+    def _formatGeneric(self, record):
+        """
+        Format using the base class and recover the preamble by searching
+        for the message in the result
+        """
+        msg = logging.Formatter.format(self, record)
+
+        if self.splitLines and record.message != "":
+            parts = msg.split(record.message, 1)
+            msg = msg.replace("\n", "\n" + parts[0])
+        # Escape new lines so the full message is in a single line
+        elif not self.splitLines and msg != "":
+            msg = msg.replace("\n", "\\n")
+
+        return msg
+
+    def _appendException(self, record, msg):
+        """
+        Append exception and stack info the same way logging.Formatter does
+        """
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            if msg[-1:] != "\n":
+                msg += "\n"
+            msg += record.exc_text
+
+        if getattr(record, "stack_info", None):
+            if msg[-1:] != "\n":
+                msg += "\n"
+            msg += self.formatStack(record.stack_info)
+
+        return msg
+
+    @staticmethod
+    def parseSpecs(specs, defaults):
+        """
+        Merge the user specs with the defaults given (terminal or file). Also
+        ensure that if ``pretty`` is set, ``splitLines`` is also set (implied)
+        """
+        specs = merge_dicts(specs, defaults.copy())
+
+        # Pretty overrides split lines
+        specs["pretty"] = specs.get("pretty", False)
+        specs["splitLines"] = specs.get("splitLines", False)
+        if specs["pretty"] and not specs["splitLines"]:
+            specs["splitLines"] = True
+
+        return specs
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format messages as JSON
+
+    Lots of ideas from:
+
+        https://github.com/madzak/python-json-logger/blob/master/src/pythonjsonlogger/jsonlogger.py
+
+
+    """
+
+    # http://docs.python.org/library/logging.html#logrecord-attributes
+    RESERVED_ATTRS = (
+        "_context",  # see bind()
+        "args",
+        "asctime",
+        "created",
+        "exc_info",
+        "exc_text",
+        "filename",
+        "funcName",
+        "levelname",
+        "levelno",
         "lineno",
         "module",
         "msecs",
@@ -432,6 +3227,7 @@ class JSONFormatter(logging.Formatter):
         "stack_info",
         "thread",
         "threadName",
+        "taskName",
     )
 
     FIELDS = [
@@ -445,39 +3241,148 @@ class JSONFormatter(logging.Formatter):
         "message",
     ]
 
-    def __init__(self, fields, datefmt=None):
-        self.fields = fields
+    STATIC_FIELDS = ("process",)
+    """Fields that do not change within a process and are serialized once"""
+
+    TIMESTAMPS = ("epoch", "iso")
+    """Formats of "timestamp": seconds as a float or ISO-8601 local time"""
+
+    def __init__(self, fields, datefmt=None, static=None, timestamp="epoch"):
+        """
+        Init given the record attributes to include and optional constant
+        fields (ie: ``{"hostname": socket.gethostname(), "app": "foo"}``)
+        """
+        logging.Formatter.__init__(self, None, datefmt)
+
+        if timestamp not in JSONFormatter.TIMESTAMPS:
+            raise RuntimeError('Unknown timestamp format "%s"' % timestamp)
+        self.timestamp = timestamp
+        self._times = TimestampCache()
+
+        # Copy, so we never modify the list we were given (ie: FIELDS)
+        self.fields = list(fields)
         if "created" not in self.fields:
             self.fields.append("created")
 
+        self.static = dict(static) if static is not None else {}
+
+        # Record attributes copied on every record as (attribute, key) pairs.
+        # "message" is always derived from msg below
+        self._project = tuple(
+            (k, "timestamp" if k == "created" else k)
+            for k in self.fields
+            if k != "message" and k not in JSONFormatter.STATIC_FIELDS
+        )
+
+        # Anything not in here is an extra and is included as is
+        self._known = frozenset(JSONFormatter.RESERVED_ATTRS) | frozenset(self.fields)
+
+        self._staticFields = tuple(
+            k for k in JSONFormatter.STATIC_FIELDS if k in self.fields
+        )
+        self._staticKeys = frozenset(self.static) | frozenset(self._staticFields)
+
+        # (values of STATIC_FIELDS, serialized fragment), rebuilt on fork
+        self._staticCache = (None, None)
+
+    def _staticFragment(self, record):
+        """
+        Return the pre-serialized constant fields (without the braces), or
+        None if there are none
+        """
+        key = tuple(getattr(record, k, None) for k in self._staticFields)
+        cached = self._staticCache
+        if cached[0] == key and cached[1] is not None:
+            return cached[1]
+
+        values = dict(self.static)
+        values.update(zip(self._staticFields, key))
+        fragment = json.dumps(values)[1:-1] if values else ""
+
+        self._staticCache = (key, fragment)
+        return fragment
+
     def format(self, record):
         """
         Override format function
         """
         result = {"message": ""}
+        raw = Lazy.resolve(record.msg)
 
         # Assign string to message
-        if isinstance(record.msg, str_types):
-            result["message"] = record.msg
+        if isinstance(raw, str_types):
+            result["message"] = record.getMessage()
         # Merge as dict
-        elif isinstance(record.msg, dict):
-            result = merge_dicts(record.msg, result)
+        elif isinstance(raw, dict):
+            result.update(raw)
         # Serialize as object
         else:
-            result["object"] = record.msg
+            result["object"] = raw
+
+        # Required attrs
+        values = record.__dict__
+        for attr, key in self._project:
+            if attr in values:
+                result[key] = values[attr]
+        if self.timestamp == "iso":
+            result["timestamp"] = self._times.iso(
+                record.created, record.msecs, self.converter
+            )
+
+        # Custom/extra
+        extra = values.keys() - self._known
+        if extra:
+            for k in values:
+                if k in extra:
+                    result[k] = values[k]
+
+        fragment = self._staticFragment(record)
+        context = values.get("_context")
+        if context is None:
+            if not fragment:
+                return json.dumps(result)
+            if self._staticKeys.isdisjoint(result):
+                return "{" + fragment + ", " + json.dumps(result)[1:]
+        elif context.keys.isdisjoint(result) and context.keys.isdisjoint(
+            self._staticKeys
+        ):
+            # Bound context, serialized already
+            if fragment:
+                fragment += ", " + context.fragment
+            else:
+                fragment = context.fragment
+            if self._staticKeys.isdisjoint(result):
+                return "{" + fragment + ", " + json.dumps(result)[1:]
+
+        # Rare: the message or an extra overrides a constant (or bound) field
+        merged = dict(self.static)
+        if context is not None:
+            merged.update(context.values)
+        merged.update(result)
+        for k in self._staticFields:
+            merged[k] = values.get(k)
+
+        return json.dumps(merged)
+
+
+# Attributes of every LogRecord, anything else is an extra
+_RESERVED = frozenset(JSONFormatter.RESERVED_ATTRS)
 
-        # Now merge any extra
-        for k, v in record.__dict__.items():
-            # Required attrs
-            if k in self.fields:
-                if k == "created":
-                    k = "timestamp"
-                result[k] = v
-            # Custom/extra
-            elif k not in JSONFormatter.RESERVED_ATTRS:
-                result[k] = v
 
-        return json.dumps(result)
+def _extras(values):
+    """
+    Extras of a record's ``__dict__``, bound context included (the record's
+    own win), None if there are none
+    """
+    extra = values.keys() - _RESERVED
+    context = values.get("_context")
+    if not extra and context is None:
+        return None
+
+    out = dict(context.values) if context is not None else {}
+    for k in extra:
+        out[k] = values[k]
+    return out
 
 
 #
@@ -485,42 +3390,175 @@ class JSONFormatter(logging.Formatter):
 #
 
 
-def pretty_recursive(value, htchar="\t", lfchar="\n", indent=0):
+try:
+    from collections.abc import MutableMapping
+except BaseException:
+    from collections import MutableMapping
+
+
+PRETTY_BRACKETS = (
+    (dict, "{", "}"),
+    (MutableMapping, "{", "}"),
+    (list, "[", "]"),
+    (tuple, "(", ")"),
+)
+"""Containers expanded by :py:func:`pretty_format` with their brackets"""
+
+TRUNCATED = "..."
+"""Marker for output cut short by the pretty printer limits"""
+
+_NOTHING = object()
+_BRACKETS = dict((cls, (op, cl)) for cls, op, cl in PRETTY_BRACKETS)
+_CONTAINERS = tuple(cls for cls, _, _ in PRETTY_BRACKETS)
+
+
+def _brackets(value):
     """
-    Recursive pretty printing of dict, list and tuples - full creadit to:
+    Return (opener, closer) if value is expanded by the pretty printer
+    """
+    brackets = _BRACKETS.get(type(value))
+    if brackets is None and isinstance(value, _CONTAINERS):
+        for cls, op, cl in PRETTY_BRACKETS:
+            if isinstance(value, cls):
+                return op, cl
+    return brackets
+
+
+def pretty_format(
+    value,
+    htchar="\t",
+    lfchar="\n",
+    indent=0,
+    maxDepth=None,
+    maxItems=None,
+    maxChars=None,
+):
+    """
+    Pretty print dicts, lists and tuples without recursion. Output is written
+    into a single buffer and can be limited:
+
+    - ``maxDepth``: containers nested deeper are shown as ``{...}``
+    - ``maxItems``: items after that are replaced by ``... (N more)``
+    - ``maxChars``: the output is cut and ends with ``...``
+
+    Self-referencing containers are shown as ``{...}`` like ``repr()`` does.
+    Layout credit goes to:
 
     http://stackoverflow.com/questions/3229419/pretty-printing-nested-dictionaries-in-python
 
     """
-    nlch = lfchar + htchar * (indent + 1)
+    if maxChars is None:
+        maxChars = float("inf")
+
+    out = []
+    write = out.append
+    size = 0
+
+    # indents[i] is a new line followed by i (+ indent) indentation chars
+    indents = [lfchar + htchar * indent]
+
+    # Frames of the containers being written:
+    # [iterator, mapping or None, closer, depth, id, items written]
+    stack = []
+    active = set()
+
+    brackets = _brackets(value)
+    while True:
+        # Write a leaf or open a container
+        if brackets is None:
+            chunk = repr(value)
+        elif id(value) in active or (maxDepth is not None and len(stack) >= maxDepth):
+            chunk = brackets[0] + TRUNCATED + brackets[1]
+        else:
+            chunk = brackets[0]
+            mapping = value if brackets[0] == "{" else None
+            stack.append([iter(value), mapping, brackets[1], len(stack), id(value), 0])
+            active.add(id(value))
+            if len(indents) <= len(stack):
+                indents.append(indents[-1] + htchar)
+
+        write(chunk)
+        size += len(chunk)
+
+        # Move on to the next container: leaves are written right here,
+        # finished containers are closed
+        brackets = None
+        while stack and size <= maxChars:
+            frame = stack[-1]
+            it, mapping, closer, depth, oid, count = frame
+            first = indents[depth + 1]
+            sep = "," + first
+
+            for item in it:
+                if count == maxItems:
+                    chunk = "%s%s (%d more)" % (
+                        sep if count else first,
+                        TRUNCATED,
+                        1 + sum(1 for _ in it),
+                    )
+                    write(chunk)
+                    size += len(chunk)
+                    break
+
+                chunk = sep if count else first
+                count += 1
+                if mapping is not None:
+                    chunk += repr(item) + ": "
+                    value = mapping[item]
+                else:
+                    value = item
+
+                brackets = _BRACKETS.get(type(value))
+                if brackets is None and isinstance(value, _CONTAINERS):
+                    brackets = _brackets(value)
+                if brackets is not None:
+                    break
+
+                chunk += repr(value)
+                write(chunk)
+                size += len(chunk)
+                if size > maxChars:
+                    break
+
+            if brackets is not None:
+                # Opened by the outer loop
+                frame[5] = count
+                write(chunk)
+                size += len(chunk)
+                break
+
+            if size > maxChars:
+                break
+
+            chunk = indents[depth] + closer
+            stack.pop()
+            active.discard(oid)
+            write(chunk)
+            size += len(chunk)
+
+        if brackets is None:
+            break
+
+    result = "".join(out)
+    if len(result) > maxChars:
+        result = result[:maxChars] + TRUNCATED
+
+    return result
 
-    if isinstance(value, dict) or isinstance(value, collections.MutableMapping):
-        items = [
-            nlch
-            + repr(key)
-            + ": "
-            + pretty_recursive(value[key], htchar, lfchar, indent + 1)
-            for key in value
-        ]
-        return "{%s}" % (",".join(items) + lfchar + htchar * indent)
-    elif isinstance(value, list):
-        items = [
-            nlch + pretty_recursive(item, htchar, lfchar, indent + 1) for item in value
-        ]
-        return "[%s]" % (",".join(items) + lfchar + htchar * indent)
-    elif isinstance(value, tuple):
-        items = [
-            nlch + pretty_recursive(item, htchar, lfchar, indent + 1) for item in value
-        ]
-        return "(%s)" % (",".join(items) + lfchar + htchar * indent)
-    else:
-        return repr(value)
+
+def pretty_recursive(value, htchar="\t", lfchar="\n", indent=0):
+    """
+    Kept for backwards compatibility, see :py:func:`pretty_format`
+    """
+    return pretty_format(value, htchar, lfchar, indent)
 
 
-def pretty(sth):
+def pretty(sth, maxDepth=None, maxItems=None, maxChars=None):
     """
-    Format objects, tuples, lists and dicts for pretty printing
+    Format objects, tuples, lists and dicts for pretty printing. See
+    :py:func:`pretty_format` for the limits
     """
+    sth = Lazy.resolve(sth)
     if sth is None:
         return sth
 
@@ -528,7 +3566,127 @@ def pretty(sth):
     if sth.__class__.__name__:
         prefix = "(%s) " % format(sth.__class__.__name__)
 
-    return prefix + pretty_recursive(sth)
+    return prefix + pretty_format(
+        sth, maxDepth=maxDepth, maxItems=maxItems, maxChars=maxChars
+    )
+
+
+class Lazy(object):
+    """
+    A message computed only when a handler actually writes it, ie::
+
+        logging.debug(lazy(lambda: expensive_dump(state)))
+
+    The result is kept, so it is computed once however many handlers write
+    the record. In queue mode it is computed on the writer thread
+    """
+
+    __slots__ = ("fn", "args", "kwargs", "_value")
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self._value = _NOTHING
+
+    def value(self):
+        if self._value is _NOTHING:
+            self._value = self.fn(*self.args, **self.kwargs)
+        return self._value
+
+    def __str__(self):
+        return str(self.value())
+
+    def __repr__(self):
+        return repr(self.value())
+
+    @staticmethod
+    def resolve(msg):
+        """
+        Return the value of ``msg`` if lazy, or ``msg`` itself
+        """
+        if isinstance(msg, Lazy):
+            return msg.value()
+        return msg
+
+
+def lazy(fn, *args, **kwargs):
+    """
+    Shortcut for :py:class:`Lazy`
+    """
+    return Lazy(fn, *args, **kwargs)
+
+
+class Context(object):
+    """
+    Values bound with :py:func:`bind`. They are serialized once, here, and
+    :py:class:`JSONFormatter` splices ``fragment`` into every line
+    """
+
+    __slots__ = ("values", "keys", "fragment")
+
+    def __init__(self, values):
+        self.values = values
+        self.keys = frozenset(values)
+        self.fragment = json.dumps(values)[1:-1]
+
+
+_CONTEXT = contextvars.ContextVar("lazylog", default=None) if contextvars else None
+
+
+def _contextFactory(factory):
+    """
+    Wrap a LogRecord factory to attach the bound :py:class:`Context` as
+    ``_context``, in the caller's thread/task (not in the queue's thread)
+    """
+
+    def makeRecord(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        context = _CONTEXT.get()
+        if context is not None:
+            record._context = context
+        return record
+
+    makeRecord.lazylog = True
+    return makeRecord
+
+
+def bind(name=None, **values):
+    """
+    Add ``values`` to every record logged from now on in the current
+    context: the thread, or the asyncio task (and tasks it starts). Returns
+    the logger ``name`` (root by default), ie::
+
+        log = lazylog.bind(request_id=rid, tenant=tenant)
+        log.info("Started")
+
+    JSON output gets them as fields, collector and binary files as extras
+    """
+    if _CONTEXT is None:
+        raise RuntimeError("bind() needs contextvars (python 3.7+)")
+
+    factory = logging.getLogRecordFactory()
+    if not getattr(factory, "lazylog", False):
+        logging.setLogRecordFactory(_contextFactory(factory))
+
+    current = _CONTEXT.get()
+    if current is not None:
+        merged = dict(current.values)
+        merged.update(values)
+        values = merged
+    _CONTEXT.set(Context(values) if values else None)
+    return logging.getLogger(name)
+
+
+def unbind(*keys):
+    """
+    Remove ``keys`` from the current context, all of them if none given
+    """
+    current = _CONTEXT.get() if _CONTEXT is not None else None
+    if current is None:
+        return
+    values = dict((k, v) for k, v in current.values.items() if keys and k not in keys)
+    _CONTEXT.set(Context(values) if values else None)
 
 
 def mkdir_p(path):
@@ -0,0 +1,39 @@
+"""
+Asyncio integration. Records logged from coroutines are queued without
+blocking the event loop, formatting, writing and rotation happen in
+lazylog's background thread (see ``queue`` in :py:meth:`lazylog.Logger.init`)::
+
+    Logger.init(folder, termSpecs=termSpecs, fileSpecs=fileSpecs)
+    lazylog.aio.install()
+    ...
+    await lazylog.aio.flush()   # ie: on shutdown
+
+Records are dropped (and counted in :py:meth:`lazylog.Logger.dropped`) rather
+than stalling the loop if the queue is full.
+"""
+
+import asyncio
+
+from lazylog import Logger
+
+
+def install(queueSize=None):
+    """
+    Hand records over to the writer thread from now on, call it after
+    :py:meth:`lazylog.Logger.init` (which resets the mode)
+    """
+    Logger.startQueue(queueSize)
+
+
+def _flush():
+    Logger.flush()
+    for handler in Logger.getHandlers():
+        handler.flush()
+
+
+async def flush():
+    """
+    Wait, without blocking the loop, until everything logged so far is
+    written out (buffered files included)
+    """
+    await asyncio.get_event_loop().run_in_executor(None, _flush)
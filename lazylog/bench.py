@@ -0,0 +1,355 @@
+"""
+Benchmarks for lazylog's hot paths: formatters, the pretty printer and full
+console + file setups. Run with::
+
+    python -m lazylog.bench -o results.json
+    python -m lazylog.bench -b results.json     # compare, flag regressions
+
+Each benchmark reports records per second (best round) and the per-record
+latency (median round).
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+
+from lazylog import Logger, ColorFormatter, JSONFormatter, pretty, shared_memory
+
+BENCHMARKS = []
+"""Registered benchmarks as (name, factory), see :py:func:`benchmark`"""
+
+TOLERANCE = 0.1
+"""Default slowdown (fraction of records/s) reported as a regression"""
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated factory returns ``fn(n)`` which
+    handles ``n`` records
+    """
+
+    def register(factory):
+        BENCHMARKS.append((name, factory))
+        return factory
+
+    return register
+
+
+def makeRecord(msg, args=None, level=logging.INFO, **extra):
+    record = logging.LogRecord(
+        "bench", level, __file__, 42, msg, args, None, "bench_function"
+    )
+    record.__dict__.update(extra)
+    return record
+
+
+MULTILINE = "\n".join("line %d of a multi-line message" % i for i in range(10))
+
+NESTED = {
+    "user": {"id": 1234, "name": "someone", "roles": ["admin", "dev"]},
+    "request": {"path": "/api/v1/things", "args": {"page": 1, "size": 50}},
+    "items": [{"id": i, "tags": ("a", "b")} for i in range(5)],
+}
+
+
+def _formatter(formatter, record):
+    format = formatter.format
+    rendered = ColorFormatter._rendered
+
+    def fn(n):
+        for _ in range(n):
+            # As a new record, not what ColorFormatter kept the last time
+            rendered.last = None
+            format(record)
+
+    return fn
+
+
+#
+# ColorFormatter
+#
+
+for _color in (True, False):
+    for _split in (True, False):
+        for _pretty in (True, False):
+
+            def _factory(color=_color, split=_split, prty=_pretty):
+                formatter = ColorFormatter(
+                    Logger.LOGFORMAT,
+                    datefmt=Logger.DATEFORMAT,
+                    color=color,
+                    splitLines=split,
+                    pretty=prty,
+                )
+                return _formatter(formatter, makeRecord(NESTED if prty else MULTILINE))
+
+            benchmark(
+                "color.format[color=%d,split=%d,pretty=%d]" % (_color, _split, _pretty)
+            )(_factory)
+
+del _color, _split, _pretty, _factory
+
+
+@benchmark("color.format[simple]")
+def colorSimple():
+    formatter = ColorFormatter(Logger.LOGFORMAT, datefmt=Logger.DATEFORMAT)
+    return _formatter(formatter, makeRecord("Simple %s message", ("str",)))
+
+
+#
+# JSONFormatter
+#
+
+
+@benchmark("json.format[str]")
+def jsonStr():
+    formatter = JSONFormatter(JSONFormatter.FIELDS)
+    return _formatter(formatter, makeRecord("Simple %s message", ("str",)))
+
+
+@benchmark("json.format[dict]")
+def jsonDict():
+    formatter = JSONFormatter(JSONFormatter.FIELDS)
+    return _formatter(formatter, makeRecord(NESTED, user="someone"))
+
+
+@benchmark("json.format[object]")
+def jsonObject():
+    formatter = JSONFormatter(JSONFormatter.FIELDS)
+    return _formatter(formatter, makeRecord(["a", 1, 2.5, None]))
+
+
+#
+# pretty()
+#
+
+
+def _pretty(value):
+    def fn(n):
+        for _ in range(n):
+            pretty(value)
+
+    return fn
+
+
+@benchmark("pretty[small]")
+def prettySmall():
+    return _pretty({"hello": 1, "world": [1, 2]})
+
+
+@benchmark("pretty[medium]")
+def prettyMedium():
+    return _pretty(NESTED)
+
+
+@benchmark("pretty[large]")
+def prettyLarge():
+    return _pretty(dict(("key%d" % i, NESTED) for i in range(50)))
+
+
+#
+# End to end
+#
+
+
+def _endToEnd(threads, fileFormat="console", **kwargs):
+    folder = tempfile.mkdtemp(prefix="lazylog-bench-")
+    fileSpecs = [
+        {"filename": "bench.log", "level": logging.DEBUG, "format": fileFormat}
+    ]
+    Logger.init(
+        folder, termSpecs={"level": logging.DEBUG}, fileSpecs=fileSpecs, **kwargs
+    )
+
+    # The console goes nowhere, we are measuring lazylog not the terminal
+    console = Logger.getHandlers()[0]
+    console.stream = open(os.devnull, "w")
+
+    log = logging.getLogger("bench")
+
+    def work(n):
+        for i in range(n):
+            log.info("Request %d handled in %.2fms", i, 1.5)
+
+    def fn(n):
+        if threads == 1:
+            work(n)
+        else:
+            workers = [
+                threading.Thread(target=work, args=(n // threads,))
+                for _ in range(threads)
+            ]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        Logger.flush()
+
+    fn.cleanup = lambda: _cleanup(folder, console)
+    return fn
+
+
+def _cleanup(folder, console):
+    Logger.stopQueue()
+    for h in list(logging.getLogger().handlers):
+        h.close()
+    logging.getLogger().handlers = []
+    console.stream.close()
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+@benchmark("e2e[console+file,threads=1]")
+def endToEnd():
+    return _endToEnd(1)
+
+
+@benchmark("e2e[console+file,threads=1,binary]")
+def endToEndBinary():
+    return _endToEnd(1, fileFormat="binary")
+
+
+@benchmark("e2e[console+file,threads=4]")
+def endToEndThreads():
+    return _endToEnd(4)
+
+
+@benchmark("e2e[console+file,threads=4,queue]")
+def endToEndQueue():
+    return _endToEnd(4, queue=True, queueSize=1000000)
+
+
+if shared_memory is not None:
+
+    @benchmark("e2e[console+file,threads=4,ring]")
+    def endToEndRing():
+        return _endToEnd(4, ringSize=64 * 1024 * 1024)
+
+
+#
+# Runner
+#
+
+
+def run(factory, number, repeat):
+    """
+    Run a benchmark ``repeat`` times with ``number`` records each
+    """
+    fn = factory()
+    try:
+        # Warm up
+        fn(max(number // 10, 1))
+
+        rounds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(number)
+            rounds.append(time.perf_counter() - start)
+    finally:
+        if hasattr(fn, "cleanup"):
+            fn.cleanup()
+
+    rounds.sort()
+    return {
+        "records": number,
+        "ops": number / rounds[0],
+        "latency_us": rounds[len(rounds) // 2] / number * 1e6,
+    }
+
+
+def runAll(number=10000, repeat=5, only=None, out=None):
+    out = out or sys.stdout
+    results = {}
+    for name, factory in BENCHMARKS:
+        if only and not any(o in name for o in only):
+            continue
+        results[name] = run(factory, number, repeat)
+        out.write(
+            "%-45s %12.0f rec/s %10.2f us\n"
+            % (name, results[name]["ops"], results[name]["latency_us"])
+        )
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=TOLERANCE, out=None):
+    """
+    Compare results with a baseline and return the names of the benchmarks
+    that got slower by more than ``tolerance``
+    """
+    out = out or sys.stdout
+    regressions = []
+    for name, result in sorted(current["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+
+        change = result["ops"] / base["ops"] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        out.write("%-45s %+7.1f%%%s\n" % (name, change * 100, flag))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lazylog.bench", description="Benchmark lazylog"
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=10000, help="Records per round"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="Rounds per benchmark"
+    )
+    parser.add_argument(
+        "-k", "--only", nargs="*", help="Run benchmarks containing these"
+    )
+    parser.add_argument("-o", "--output", help="Save the results (JSON) here")
+    parser.add_argument("-b", "--baseline", help="Compare with these saved results")
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="Slowdown flagged as regression (default %(default)s)",
+    )
+    parser.add_argument("-l", "--list", action="store_true", help="List benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return 0
+
+    current = runAll(args.number, args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nCompared to %s:\n" % args.baseline)
+        if compare(current, baseline, args.tolerance):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
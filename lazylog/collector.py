@@ -0,0 +1,219 @@
+"""
+Log collector: receives records from many processes over a Unix socket and
+does all the formatting and rotated file writing in one place. Run with::
+
+    python -m lazylog.collector /run/app/log.sock -d /var/log/app -c files.json
+
+where ``files.json`` holds the ``fileSpecs`` list of
+:py:meth:`lazylog.Logger.init`, and point the apps to it with::
+
+    Logger.init(folder, fileSpecs=fileSpecs, collector="/run/app/log.sock")
+
+The apps keep their console output and use ``fileSpecs`` as a local fallback
+while the collector is not reachable.
+"""
+
+import os
+import sys
+import json
+import socket
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+
+from lazylog import Logger, CollectorHandler
+
+MAXFRAME = 64 * 1024 * 1024
+"""Largest batch (bytes) accepted, anything bigger closes the connection"""
+
+MODE = 0o660
+"""Default socket permissions: the collector's user and group may log, widen
+it (ie: ``-m 666``) to let any local user write to the logs"""
+
+
+def readFrames(rfile):
+    """
+    Yield the batches (lists of packed records) read from ``rfile`` until
+    the other side closes. A truncated last frame is dropped
+    """
+    header = CollectorHandler.HEADER
+    while True:
+        head = rfile.read(header.size)
+        if len(head) < header.size:
+            return
+
+        size = header.unpack(head)[0]
+        if size > MAXFRAME:
+            raise ValueError("Frame of %d bytes is too large" % size)
+
+        data = rfile.read(size)
+        if len(data) < size:
+            return
+        yield json.loads(data.decode("utf-8"))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    One connection (process): rebuild its records and pass them to the root
+    logger's handlers
+    """
+
+    def handle(self):
+        root = logging.getLogger()
+        unpack = CollectorHandler.unpack
+        try:
+            for batch in readFrames(self.rfile):
+                self.server.batches += 1
+                for packed in batch:
+                    root.handle(unpack(packed))
+        except (OSError, ValueError):
+            # Broken connection or garbage, the client falls back locally
+            pass
+
+
+class Collector(socketserver.ThreadingUnixStreamServer):
+    """
+    Unix socket server feeding the handlers set up by :py:meth:`Logger.init`.
+    On close, whatever the clients already sent is still written
+    """
+
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, path, mode=MODE):
+        self.path = path
+        self.batches = 0
+        self.lock = threading.Lock()
+        self.connections = set()
+        Collector.clearStale(path)
+
+        # Nobody else can connect before the chmod
+        umask = os.umask(0o177)
+        try:
+            socketserver.ThreadingUnixStreamServer.__init__(self, path, RequestHandler)
+        finally:
+            os.umask(umask)
+        try:
+            os.chmod(path, mode)
+        except OSError:
+            pass
+
+    @staticmethod
+    def clearStale(path):
+        """
+        Remove a socket left behind by a collector that is gone. Raises
+        RuntimeError if one is still listening there
+        """
+        if not os.path.exists(path):
+            return
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+        finally:
+            sock.close()
+        raise RuntimeError("A collector is already listening on %s" % path)
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        socketserver.ThreadingUnixStreamServer.process_request(
+            self, request, client_address
+        )
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        socketserver.ThreadingUnixStreamServer.shutdown_request(self, request)
+
+    def server_close(self):
+        # Clients that connected but were not accepted yet
+        self.socket.setblocking(False)
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except OSError:
+                break
+            self.process_request(request, client_address)
+
+        # Reads return what is queued and then EOF, so every connection
+        # thread finishes and server_close() can wait for them
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lazylog.collector",
+        description="Collect records from many processes and write the log files",
+    )
+    parser.add_argument("socket", help="Unix socket to listen on")
+    parser.add_argument("-d", "--folder", default="/var/log/lazylog", help="Log folder")
+    parser.add_argument("-c", "--config", help="JSON file with the fileSpecs list")
+    parser.add_argument(
+        "-f",
+        "--filename",
+        default="collector.log",
+        help="Log file when there is no config",
+    )
+    parser.add_argument("--fmt", help="Log format (default Logger.LOGFORMAT)")
+    parser.add_argument("--datefmt", help="Date format (default Logger.DATEFORMAT)")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=lambda v: int(v, 8),
+        default=MODE,
+        help="Socket permissions (octal)",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Echo records to the console"
+    )
+    args = parser.parse_args(argv)
+
+    if args.config:
+        with open(args.config) as f:
+            fileSpecs = json.load(f)
+    else:
+        fileSpecs = [{"filename": args.filename, "level": logging.DEBUG}]
+
+    termSpecs = {"level": logging.DEBUG if args.verbose else logging.CRITICAL + 1}
+    Logger.init(
+        args.folder,
+        termSpecs=termSpecs,
+        fileSpecs=fileSpecs,
+        fmt=args.fmt,
+        datefmt=args.datefmt,
+    )
+
+    server = Collector(args.socket, args.mode)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever(), which runs in this thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        logging.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,679 @@
+"""
+Search log files written by lazylog, including their rotated and compressed
+backups. Run with::
+
+    python -m lazylog.grep /var/log/app/app.log "Timeout" --since 14:02 --until 14:05
+    python -m lazylog.grep app.log app.json -l WARNING -m db api -E "user=\\d+"
+
+Console (any ``fmt``), JSON and binary files are understood. Files are
+scanned in parallel by a process pool and matches are written oldest first,
+files that cannot hold records in the time range are skipped. Files with an
+index (``"index": True``) are only read where it says matches can be.
+
+The same is available in code as :py:func:`query`.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import fnmatch
+import calendar
+import logging
+import argparse
+import datetime
+import multiprocessing
+
+from lazylog import Logger, ColorFormatter, BinaryFileHandler, RotatingFileHandler
+from lazylog.render import openFile, formatRecord, OPENERS
+
+BACKUP = re.compile(
+    r"\.(\d+|s\d+|\d{8}-\d{6}-\d{6})(%s)?$" % "|".join(re.escape(e) for e in OPENERS)
+)
+"""Suffix of the backups of any rotation mode, maybe compressed"""
+
+ISOTIME = re.compile(
+    r"(\d{4}-\d\d-\d\d)[T ](\d\d:\d\d:\d\d)(\.\d+)?(?:([+-])(\d\d):?(\d\d)|(Z))?$"
+)
+"""ISO-8601 times of ``"timestamp": "iso"``, for pythons before 3.7"""
+
+FIELD = re.compile(r"%\((\w+)\)[-#0 +]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa]")
+
+NUMERIC = (
+    "created",
+    "msecs",
+    "relativeCreated",
+    "lineno",
+    "levelno",
+    "process",
+    "thread",
+)
+
+DIRECTIVES = {
+    "Y": r"\d{4}",
+    "f": r"\d+",
+    "j": r"\d{3}",
+    "a": r"\w+",
+    "A": r"\w+",
+    "b": r"\w+",
+    "B": r"\w+",
+    "p": r"\w+",
+    "z": r"[+-]\d{4}",
+    "Z": r"\w*",
+    "%": "%",
+}
+"""strftime directives that are not two digits, as regular expressions"""
+
+
+def logFiles(path):
+    """
+    Return ``path`` and its backups, oldest first by modification time (the
+    current file is always last)
+    """
+    dirname, basename = os.path.split(path)
+    backups = []
+    for name in os.listdir(dirname or "."):
+        if name.startswith(basename + ".") and BACKUP.match(name, len(basename)):
+            full = os.path.join(dirname, name)
+            backups.append((os.path.getmtime(full), full))
+
+    files = [p for _, p in sorted(backups)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def dateRegex(datefmt):
+    out = []
+    i = 0
+    while i < len(datefmt):
+        c = datefmt[i]
+        if c == "%" and i + 1 < len(datefmt):
+            out.append(DIRECTIVES.get(datefmt[i + 1], r"\d{2}"))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+def headerRegex(fmt, datefmt):
+    """
+    Compile a regular expression matching the lines ``fmt`` produces, with a
+    group per record attribute
+    """
+    parts = []
+    seen = set()
+    pos = 0
+    for m in FIELD.finditer(fmt):
+        parts.append(re.escape(fmt[pos : m.start()]))
+        pos = m.end()
+
+        name = m.group(1)
+        group = "(?P<%s>" % name if name not in seen else "(?:"
+        seen.add(name)
+        if name == "message":
+            parts.append(group + ".*)")
+        elif name == "asctime":
+            parts.append(group + dateRegex(datefmt) + ")")
+        elif name in NUMERIC:
+            parts.append(" *" + group + r"[\d.]+) *")
+        else:
+            parts.append(" *" + group + r"\S*?) *")
+
+    parts.append(re.escape(fmt[pos:]))
+    return re.compile("".join(parts))
+
+
+def isoTime(text):
+    """
+    Seconds since the epoch of an ISO-8601 time, ie:
+    ``2018-05-08T21:40:16.943+01:00``. Raises ValueError
+    """
+    if hasattr(datetime.datetime, "fromisoformat"):
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+    m = ISOTIME.match(text)
+    if m is None:
+        raise ValueError("Not an ISO-8601 time: %r" % text)
+    date, clock, fraction, sign, hours, minutes, utc = m.groups()
+    tt = time.strptime(date + " " + clock, "%Y-%m-%d %H:%M:%S")
+    if sign is None and utc is None:
+        seconds = time.mktime(tt)
+    else:
+        seconds = calendar.timegm(tt)
+        if sign is not None:
+            offset = int(hours) * 3600 + int(minutes) * 60
+            seconds += -offset if sign == "+" else offset
+    return seconds + float(fraction or 0)
+
+
+def parseTime(value, now=None):
+    """
+    Parse a time given on the command line: epoch seconds, ``-15m`` (also
+    ``s``, ``h``, ``d``), ``HH:MM[:SS]`` today or ``YYYY-mm-dd HH:MM[:SS]``
+    """
+    now = time.time() if now is None else now
+    m = re.match(r"^-(\d+(?:\.\d+)?)([smhd])$", value)
+    if m:
+        return (
+            now
+            - float(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+        )
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.replace("T", " ")
+    for fmt in (
+        "%Y-%m-%d %H:%M:%S.%f",
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%d %H:%M",
+        "%Y-%m-%d",
+    ):
+        try:
+            return time.mktime(datetime.datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+
+    today = datetime.date.fromtimestamp(now)
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            t = datetime.datetime.strptime(value, fmt).time()
+        except ValueError:
+            continue
+        return time.mktime(datetime.datetime.combine(today, t).timetuple())
+
+    raise ValueError('Cannot understand time "%s"' % value)
+
+
+class Query(object):
+    """
+    What to look for. Each record (with all its lines) is matched against
+    every criteria given:
+
+    - ``pattern``: substring, or regular expression with ``regex``
+    - ``since``/``until``: epoch seconds
+    - ``level``: minimum level (name or number)
+    - ``modules``: module names, globs allowed
+
+    ``fmt``/``datefmt`` are the ones the console-format files were written
+    with. Split lines of a record share its preamble, so records of the same
+    call site and millisecond cannot be told apart from them: the matching
+    lines of such groups are returned, not the whole group
+    """
+
+    SLACK = 1.0
+    """Seconds of margin between index times and the (truncated) ones read"""
+
+    def __init__(
+        self,
+        pattern=None,
+        regex=False,
+        ignoreCase=False,
+        since=None,
+        until=None,
+        level=None,
+        modules=None,
+        fmt=Logger.LOGFORMAT,
+        datefmt=Logger.DATEFORMAT,
+    ):
+        self.pattern = pattern
+        self.since = since
+        self.until = until
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        self.level = level
+        self.modules = list(modules) if modules else None
+        self.fmt = fmt
+        self.datefmt = datefmt
+
+        self._header = headerRegex(fmt, datefmt)
+
+        # Plain substrings are faster with "in"
+        self._regex = None
+        if pattern is not None and (regex or ignoreCase):
+            self._regex = re.compile(
+                pattern if regex else re.escape(pattern), re.I if ignoreCase else 0
+            )
+
+        # Without a pattern, rare levels are found by their name, the bulk
+        # (DEBUG/INFO) is quicker to parse line by line
+        self._levelNames = None
+        if pattern is None and level is not None and level > logging.INFO:
+            self._levelNames = [
+                n for l, n in logging._levelToName.items() if l >= level
+            ]
+
+        self._levels = {}
+        self._lastTime = (None, None)
+
+    def match(self, when, levelname, module, text):
+        """
+        Check a record against the query
+        """
+        if when is not None:
+            if self.since is not None and when < self.since:
+                return False
+            if self.until is not None and when > self.until:
+                return False
+
+        if self.level is not None and levelname is not None:
+            levelno = self._levels.get(levelname)
+            if levelno is None:
+                levelno = logging.getLevelName(levelname)
+                self._levels[levelname] = levelno = (
+                    levelno if isinstance(levelno, int) else 0
+                )
+            if levelno < self.level:
+                return False
+
+        if self.modules is not None:
+            if module is None or not any(
+                fnmatch.fnmatchcase(module, m) for m in self.modules
+            ):
+                return False
+
+        return self._contains(text)
+
+    def _contains(self, text):
+        if self._regex is not None:
+            return self._regex.search(text) is not None
+        return self.pattern is None or self.pattern in text
+
+    def _matchingLines(self, text):
+        """
+        The lines of ``text`` with the pattern if they all have the same
+        preamble (see above), else ``text``
+        """
+        lines = text.splitlines(True)
+        head = self._head(lines[0], 0)
+        if head is None or head == "{":
+            return text
+        for line in lines[1:]:
+            if self._head(line, 0) != head:
+                return text
+        # A regular expression may only match across lines
+        return "".join(l for l in lines if self._contains(l)) or text
+
+    def records(self, path):
+        """
+        Yield ``(time, levelname, module, text)`` for each record in ``path``
+        """
+        if self._binary(path):
+            formatter = ColorFormatter(self.fmt, datefmt=self.datefmt, color=False)
+            with openFile(path) as f:
+                for record in BinaryFileHandler.records(f):
+                    text = formatRecord(formatter, record) + "\n"
+                    yield record.created, record.levelname, record.module, text
+            return
+
+        with openFile(path, "rt") as f:
+            for record in self._parse(f):
+                yield record
+
+    @staticmethod
+    def _binary(path):
+        with openFile(path) as f:
+            return f.read(len(BinaryFileHandler.MAGIC)) == BinaryFileHandler.MAGIC
+
+    def _parse(self, lines):
+        """
+        Group console lines into records (continuation lines and split lines
+        with the same preamble), JSON lines are records on their own
+        """
+        current = None
+        for line in lines:
+            if line[:1] == "{":
+                if current is not None:
+                    yield current[:4]
+                    current = None
+                yield self._json(line)
+                continue
+
+            m = self._header.match(line)
+            if m is None or "message" not in m.groupdict():
+                # Continuation of a record with new lines in the message
+                if current is not None:
+                    current[3] += line
+                continue
+
+            head = line[: m.start("message")]
+            if current is not None and head == current[4]:
+                # Same record, split lines
+                current[3] += line
+                continue
+
+            if current is not None:
+                yield current[:4]
+            values = m.groupdict()
+            current = [
+                self._time(values),
+                values.get("levelname"),
+                values.get("module"),
+                line,
+                head,
+            ]
+
+        if current is not None:
+            yield current[:4]
+
+    def _json(self, line):
+        try:
+            values = json.loads(line)
+        except ValueError:
+            return None, None, None, line
+        when = values.get("timestamp")
+        if isinstance(when, str):
+            # "timestamp": "iso"
+            try:
+                when = isoTime(when)
+            except ValueError:
+                when = None
+        return when, values.get("levelname"), values.get("module"), line
+
+    def _time(self, values):
+        asctime = values.get("asctime")
+        if asctime is None:
+            created = values.get("created")
+            return float(created) if created else None
+
+        # Records come in bursts with the same second, parse it once
+        last, when = self._lastTime
+        if asctime != last:
+            try:
+                when = time.mktime(time.strptime(asctime, self.datefmt))
+            except ValueError:
+                when = None
+            self._lastTime = (asctime, when)
+
+        if when is not None and values.get("msecs"):
+            return when + float(values["msecs"]) / 1000
+        return when
+
+    def firstTime(self, path):
+        """
+        Time of the first record in ``path`` (None if unknown)
+        """
+        for when, _, _, _ in self.records(path):
+            if when is not None:
+                return when
+        return None
+
+    def scan(self, path):
+        """
+        Return the matching records of ``path`` as ``(time, text)``
+        """
+        search = self.pattern is not None or self._levelNames
+        content = None
+        if not self._binary(path):
+            content = self._indexed(path)
+            if content is None and search:
+                with openFile(path, "rt") as f:
+                    content = f.read()
+
+        if content is None:
+            records = self.records(path)
+        elif search:
+            records = self._search(content)
+        else:
+            records = self._parse(content.splitlines(True))
+
+        # Console lines grouped by their preamble
+        grouped = self.pattern is not None and content is not None
+
+        results = []
+        for when, levelname, module, text in records:
+            if when is not None and self.until is not None and when > self.until:
+                break
+            if self.match(when, levelname, module, text):
+                if grouped and text.count("\n") > 1:
+                    text = self._matchingLines(text)
+                results.append((when, text))
+        return results
+
+    def _indexed(self, path):
+        """
+        Text of the blocks of ``path`` that may match according to its index
+        (see :py:meth:`RotatingFileHandler.readIndex`), None if it cannot
+        narrow anything down. Parts that are not indexed are always included
+        """
+        if self.since is None and self.until is None and self.level is None:
+            return None
+        entries = RotatingFileHandler.readIndex(path)
+        if not entries:
+            return None
+
+        ranges = []
+        pos = 0
+        for low, high, start, end, level in entries:
+            if start < pos:
+                # Not the index of this file
+                return None
+            if start > pos:
+                ranges.append((pos, start))
+            if (
+                (self.since is None or high >= self.since - self.SLACK)
+                and (self.until is None or low <= self.until + self.SLACK)
+                and (self.level is None or level >= self.level)
+            ):
+                if ranges and ranges[-1][1] == start:
+                    ranges[-1] = (ranges[-1][0], end)
+                else:
+                    ranges.append((start, end))
+            pos = end
+
+        chunks = []
+        with openFile(path) as f:
+            for start, end in ranges:
+                f.seek(start)
+                chunks.append(f.read(end - start))
+            # The tail is not indexed yet
+            f.seek(pos)
+            chunks.append(f.read())
+        return b"".join(chunks).decode("utf-8", "replace")
+
+    def _search(self, content):
+        """
+        Yield the records of ``content`` containing the pattern (or a level
+        name). Only those are parsed, the search runs over the whole text
+        """
+        if self._regex is not None:
+            hits = (m.start() for m in self._regex.finditer(content))
+        elif self.pattern is not None:
+            hits = self._find(content, self.pattern)
+        else:
+            # Extra hits (a name in a message) are dropped by match()
+            hits = heapq.merge(*(self._find(content, n) for n in self._levelNames))
+
+        end = 0
+        for pos in hits:
+            if pos < end:
+                # Same record as the previous hit
+                continue
+            start, end = self._recordAt(content, pos)
+            for record in self._parse(content[start:end].splitlines(True)):
+                yield record
+
+    @staticmethod
+    def _find(content, pattern):
+        pos = content.find(pattern)
+        while pos >= 0:
+            yield pos
+            pos = content.find(pattern, pos + 1)
+
+    def _head(self, content, start):
+        """
+        Preamble of the line at ``start`` ("{" for JSON), None if it has none
+        """
+        if content.startswith("{", start):
+            return "{"
+        m = self._header.match(content, start)
+        if m is None or "message" not in m.groupdict():
+            return None
+        return content[start : m.start("message")]
+
+    def _recordAt(self, content, pos):
+        """
+        Start and end offsets of the record at ``pos``
+        """
+        start = content.rfind("\n", 0, pos) + 1
+        head = self._head(content, start)
+        while start > 0 and head != "{":
+            prev = content.rfind("\n", 0, start - 1) + 1
+            prevHead = self._head(content, prev)
+            if head is not None and prevHead != head:
+                break
+            start, head = prev, prevHead
+
+        end = content.find("\n", pos)
+        end = len(content) if end < 0 else end + 1
+        if head == "{":
+            return start, end
+
+        while end < len(content):
+            nextHead = self._head(content, end)
+            if nextHead is not None and nextHead != head:
+                break
+            end = content.find("\n", end)
+            end = len(content) if end < 0 else end + 1
+        return start, end
+
+    def files(self, path):
+        """
+        Files of ``path`` (see :py:func:`logFiles`) that can hold records in
+        the time range, oldest first
+        """
+        files = logFiles(path)
+        if self.since is None and self.until is None:
+            return files
+
+        firsts = [self.firstTime(f) for f in files]
+        kept = []
+        for i, f in enumerate(files):
+            # Everything here is older than the first record of the next one
+            after = firsts[i + 1] if i + 1 < len(files) else None
+            if self.since is not None and after is not None and after < self.since:
+                continue
+            if (
+                self.until is not None
+                and firsts[i] is not None
+                and firsts[i] > self.until
+            ):
+                continue
+            kept.append(f)
+        return kept
+
+
+def _scan(args):
+    query, path = args
+    return query.scan(path)
+
+
+def _stream(results):
+    for matches in results:
+        for match in matches:
+            yield match
+
+
+def query(paths, q, jobs=None):
+    """
+    Yield the ``(time, text)`` of the records matching the :py:class:`Query`
+    ``q`` in the files of ``paths`` (and their backups), oldest first.
+    ``jobs`` processes scan the files (default: one per CPU, 1 scans here)
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = [q.files(p) for p in paths]
+    jobs = jobs or min(multiprocessing.cpu_count(), max(sum(len(f) for f in files), 1))
+
+    if jobs == 1:
+        streams = [_stream(q.scan(f) for f in fs) for fs in files]
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        # imap keeps the order, so each stream is in time order already
+        streams = [_stream(pool.imap(_scan, [(q, f) for f in fs])) for fs in files]
+
+    try:
+        if len(streams) == 1:
+            for match in streams[0]:
+                yield match
+        else:
+            for match in heapq.merge(*streams, key=lambda m: m[0] or 0):
+                yield match
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lazylog.grep",
+        description="Search lazylog files and their backups",
+    )
+    parser.add_argument(
+        "files", nargs="+", help="Log files (backups are found automatically)"
+    )
+    parser.add_argument(
+        "-e", "--pattern", help="Substring (or regular expression with -E)"
+    )
+    parser.add_argument(
+        "-E", "--regex", action="store_true", help="Pattern is a regular expression"
+    )
+    parser.add_argument(
+        "-i", "--ignore-case", action="store_true", help="Case insensitive"
+    )
+    parser.add_argument(
+        "-s", "--since", type=parseTime, help="From (HH:MM[:SS], date, -15m, epoch)"
+    )
+    parser.add_argument(
+        "-u", "--until", type=parseTime, help="Until (same formats as --since)"
+    )
+    parser.add_argument("-l", "--level", help="Minimum level, ie: WARNING")
+    parser.add_argument("-m", "--module", nargs="*", help="Modules (globs allowed)")
+    parser.add_argument(
+        "--fmt", default=Logger.LOGFORMAT, help="Format of console files"
+    )
+    parser.add_argument(
+        "--datefmt", default=Logger.DATEFORMAT, help="Date format of console files"
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="Processes scanning files")
+    # Options after the pattern/files, python 3.7+
+    parse = getattr(parser, "parse_intermixed_args", parser.parse_args)
+    args = parse(argv)
+
+    # A lone extra argument that is not a file is the pattern, like grep
+    files = args.files
+    if args.pattern is None and len(files) > 1 and not os.path.exists(files[-1]):
+        args.pattern = files.pop()
+
+    q = Query(
+        args.pattern,
+        regex=args.regex,
+        ignoreCase=args.ignore_case,
+        since=args.since,
+        until=args.until,
+        level=args.level,
+        modules=args.module,
+        fmt=args.fmt,
+        datefmt=args.datefmt,
+    )
+
+    found = 0
+    try:
+        for _, text in query(files, q, args.jobs):
+            sys.stdout.write(text)
+            found += 1
+    except BrokenPipeError:
+        pass
+    return 0 if found else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Render files written with ``"format": "binary"`` as text. Run with::
+
+    python -m lazylog.render /var/log/app/trace.bin
+    python -m lazylog.render -f json /var/log/app/trace.bin.3.gz
+
+The console layout is the one of :py:class:`lazylog.ColorFormatter`, JSON the
+one of :py:class:`lazylog.JSONFormatter`. Compressed backups are read as is.
+"""
+
+import bz2
+import sys
+import gzip
+import argparse
+
+from lazylog import Logger, ColorFormatter, JSONFormatter, BinaryFileHandler
+
+try:
+    import lzma
+except BaseException:
+    lzma = None
+
+OPENERS = {".gz": gzip.open, ".bz2": bz2.open}
+"""Readers of the compressed backups, by extension"""
+
+if lzma is not None:
+    OPENERS[".xz"] = lzma.open
+
+
+def openFile(path, mode="rb"):
+    """
+    Open a log file or a compressed backup of it
+    """
+    kwargs = {} if "b" in mode else {"encoding": "utf-8", "errors": "replace"}
+    for ext, opener in OPENERS.items():
+        if path.endswith(ext):
+            return opener(path, mode, **kwargs)
+    return open(path, mode, **kwargs)
+
+
+def formatRecord(formatter, record):
+    """
+    ``formatter.format(record)``, or for a record whose arguments do not fit
+    its format string (ie: ``%d`` of a str) the format string and the
+    arguments as they are. The problem is reported on stderr
+    """
+    try:
+        return formatter.format(record)
+    except Exception as e:
+        sys.stderr.write(
+            "Bad record (%s:%s): %s\n" % (record.pathname, record.lineno, e)
+        )
+        record.msg, record.args = "%r %% %r" % (record.msg, record.args), ()
+        return formatter.format(record)
+
+
+def render(path, formatter, out=None):
+    """
+    Write the records of the binary file ``path`` to ``out`` with
+    ``formatter``, returns the number of records
+    """
+    out = out or sys.stdout
+    count = 0
+    with openFile(path) as f:
+        for record in BinaryFileHandler.records(f):
+            out.write(formatRecord(formatter, record) + "\n")
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lazylog.render", description="Render lazylog binary files"
+    )
+    parser.add_argument("files", nargs="+", help="Binary log files (oldest first)")
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("console", "json"),
+        default="console",
+        help="Output format",
+    )
+    parser.add_argument("--fmt", default=Logger.LOGFORMAT, help="Log format (console)")
+    parser.add_argument(
+        "--datefmt", default=Logger.DATEFORMAT, help="Date format (console)"
+    )
+    parser.add_argument("-c", "--color", action="store_true", help="Colors (console)")
+    parser.add_argument(
+        "-p", "--pretty", action="store_true", help="Prettify objects (console)"
+    )
+    parser.add_argument(
+        "--fields",
+        nargs="*",
+        default=JSONFormatter.FIELDS,
+        help="Record attributes (json)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.format == "json":
+        formatter = JSONFormatter(args.fields)
+    else:
+        specs = ColorFormatter.parseSpecs(
+            {"color": args.color, "pretty": args.pretty}, ColorFormatter.FILEDEFAULTS
+        )
+        formatter = ColorFormatter(
+            args.fmt,
+            datefmt=args.datefmt,
+            color=specs["color"],
+            splitLines=specs["splitLines"],
+            pretty=specs["pretty"],
+        )
+
+    try:
+        for path in args.files:
+            render(path, formatter)
+    except BrokenPipeError:
+        # ie: piped to head
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
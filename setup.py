@@ -26,15 +26,17 @@ setup(
   },
   download_url = 'https://github.com/urban-1/lazylog/archive/master.tar.gz',
   keywords = ['logging', 'color', 'logfile', 'json'],
+  python_requires='>=3.5',
   classifiers = [
     'Development Status :: 4 - Beta',
     'Environment :: Console',
     'Topic :: System :: Logging',
     'Intended Audience :: Developers',
     'License :: OSI Approved :: MIT License',
-    'Programming Language :: Python :: 2.7',
-    'Programming Language :: Python :: 3.4',
+    'Programming Language :: Python :: 3 :: Only',
     'Programming Language :: Python :: 3.5',
-    'Programming Language :: Python :: 3.6'
+    'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.7',
+    'Programming Language :: Python :: 3.8'
   ],
 )
@@ -0,0 +1,79 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import unittest
+import tempfile
+import threading
+
+from lazylog import Logger, aio
+
+LOGDIR = tempfile.gettempdir()
+
+
+class TestAio(unittest.TestCase):
+    """
+    Test logging from coroutines
+    """
+
+    @classmethod
+    def setUp(cls):
+        cls.folder = tempfile.mkdtemp(prefix="lazylog-aio-")
+
+    @classmethod
+    def tearDown(cls):
+        termSpecs = {"color": True, "splitLines": True, "level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def test_001_install_and_flush(self):
+        """
+        Slow writes do not hold the loop, flush waits for them
+        """
+        fileSpecs = [
+            {
+                "filename": "aio.log",
+                "level": logging.DEBUG,
+                "fmt": "%(message)s",
+                "bufferSize": 100,
+            },
+        ]
+        Logger.init(
+            self.folder, termSpecs={"level": logging.CRITICAL}, fileSpecs=fileSpecs
+        )
+        handler = Logger.getHandlers()[1]
+        aio.install()
+        self.assertTrue(Logger.getHandlers()[1] is handler)
+
+        threads = set()
+        emit = handler.emit
+
+        def slowEmit(record):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            emit(record)
+
+        handler.emit = slowEmit
+
+        async def request(i):
+            await asyncio.sleep(0)
+            logging.info("request %d", i)
+
+        async def main():
+            start = time.time()
+            await asyncio.gather(*(request(i) for i in range(20)))
+            took = time.time() - start
+            await aio.flush()
+            return took
+
+        loop = asyncio.new_event_loop()
+        try:
+            took = loop.run_until_complete(main())
+        finally:
+            loop.close()
+        self.assertTrue(took < 0.1)
+        self.assertFalse(threading.main_thread() in threads)
+        with open(os.path.join(self.folder, "aio.log")) as f:
+            lines = [l for l in f.read().splitlines() if l.startswith("request")]
+        self.assertEqual(["request %d" % i for i in range(20)], lines)
@@ -0,0 +1,51 @@
+import json
+import logging
+import unittest
+import tempfile
+
+from lazylog import Logger, bench
+
+try:
+    from StringIO import StringIO
+except BaseException:
+    from io import StringIO
+
+LOGDIR = tempfile.gettempdir()
+
+
+class TestBench(unittest.TestCase):
+    """
+    Test the benchmark runner (not the numbers)
+    """
+
+    @classmethod
+    def tearDown(cls):
+        termSpecs = {"color": True, "splitLines": True, "level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs)
+
+    def test_001_run(self):
+        """
+        Run a few benchmarks with tiny numbers
+        """
+        out = StringIO()
+        results = bench.runAll(20, 2, only=["json.format[str]", "e2e"], out=out)
+
+        self.assertTrue("json.format[str]" in results["results"])
+        self.assertTrue("e2e[console+file,threads=4,queue]" in results["results"])
+        self.assertFalse("pretty[small]" in results["results"])
+        for result in results["results"].values():
+            self.assertTrue(result["ops"] > 0)
+
+        # Must be serializable
+        json.dumps(results)
+
+    def test_002_compare(self):
+        """
+        Test regressions are flagged
+        """
+        baseline = {"results": {"a": {"ops": 100.0}, "b": {"ops": 100.0}}}
+        current = {"results": {"a": {"ops": 95.0}, "b": {"ops": 80.0}, "c": {"ops": 1}}}
+
+        out = StringIO()
+        self.assertEqual(["b"], bench.compare(current, baseline, 0.1, out=out))
+        self.assertTrue("REGRESSION" in out.getvalue())
@@ -0,0 +1,131 @@
+import os
+import json
+import sys
+import time
+import shutil
+import socket
+import logging
+import unittest
+import tempfile
+import subprocess
+
+from lazylog import Logger, CollectorHandler
+
+LOGDIR = tempfile.gettempdir()
+ROOTDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestCollector(unittest.TestCase):
+    """
+    Test sending records to a collector process
+    """
+
+    @classmethod
+    def setUp(cls):
+        cls.folder = tempfile.mkdtemp(prefix="lazylog-collector-")
+        cls.sock = os.path.join(cls.folder, "log.sock")
+
+    @classmethod
+    def tearDown(cls):
+        termSpecs = {"color": True, "splitLines": True, "level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def start(self, *args):
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "lazylog.collector", self.sock, "-d", self.folder]
+            + list(args),
+            cwd=ROOTDIR,
+        )
+        for _ in range(100):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.sock)
+                break
+            except OSError:
+                time.sleep(0.05)
+            finally:
+                sock.close()
+        return proc
+
+    def test_001_collector(self):
+        """
+        Records are formatted and written by the collector
+        """
+        proc = self.start(
+            "-f", "collected.log", "--fmt", "%(levelname)s %(module)s %(message)s"
+        )
+        try:
+            fileSpecs = [{"filename": "local.log", "level": logging.INFO}]
+            Logger.init(
+                self.folder,
+                termSpecs={"level": logging.CRITICAL},
+                fileSpecs=fileSpecs,
+                collector=self.sock,
+            )
+            collector = Logger.getHandlers()[1]
+
+            logging.debug("dropped")
+            logging.info("hello %s", "world")
+            logging.warning({"a": 1})
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                logging.exception("failed")
+            collector.flush()
+            self.assertTrue(collector.connected)
+            self.assertEqual(0o660, os.stat(self.sock).st_mode & 0o777)
+        finally:
+            Logger.init(LOGDIR, termSpecs={"level": logging.CRITICAL})
+            proc.terminate()
+            self.assertEqual(0, proc.wait(10))
+
+        with open(os.path.join(self.folder, "collected.log")) as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual("INFO test_collector hello world", lines[0])
+        self.assertEqual("WARNING test_collector {'a': 1}", lines[1])
+        self.assertTrue("ERROR test_collector failed" in lines)
+        self.assertEqual("ERROR test_collector ValueError: boom", lines[-1])
+        self.assertFalse(os.path.exists(os.path.join(self.folder, "local.log")))
+        self.assertFalse(os.path.exists(self.sock))
+
+    def test_002_fallback(self):
+        """
+        Without a collector records go to the local files
+        """
+        fileSpecs = [
+            {"filename": "local.log", "level": logging.INFO, "fmt": "%(message)s"}
+        ]
+        Logger.init(
+            self.folder,
+            termSpecs={"level": logging.CRITICAL},
+            fileSpecs=fileSpecs,
+            collector=self.sock,
+        )
+        logging.info("one")
+        logging.info("two %d", 2)
+        Logger.getHandlers()[1].flush()
+
+        with open(os.path.join(self.folder, "local.log")) as f:
+            self.assertEqual("one\ntwo 2\n", f.read())
+
+    def test_003_pack(self):
+        """
+        Messages come out of the socket as they would be written locally
+        """
+        import datetime
+
+        formatter = logging.Formatter("%(message)s")
+        for msg, args in (
+            ("%s and %r", ("text", (1, 2))),
+            ({"a": [1, {"b": None}]}, ()),
+            (("a", 1), ()),
+            ({"when": datetime.date(2020, 1, 1)}, ()),
+        ):
+            record = logging.LogRecord("c", logging.INFO, __file__, 1, msg, args, None)
+            data = CollectorHandler._encode([CollectorHandler.pack(record)])
+            copy = CollectorHandler.unpack(json.loads(data)[0])
+            self.assertEqual(formatter.format(record), formatter.format(copy))
+            if isinstance(msg, dict) and "a" in msg:
+                self.assertEqual(msg, copy.msg)
@@ -0,0 +1,193 @@
+import os
+import json
+import glob
+import time
+import shutil
+import logging
+import unittest
+import tempfile
+
+from lazylog import Logger, Compressor, grep
+from lazylog.render import openFile
+
+LOGDIR = tempfile.gettempdir()
+
+
+class TestGrep(unittest.TestCase):
+    """
+    Test searching log files and their backups
+    """
+
+    @classmethod
+    def setUp(cls):
+        cls.folder = tempfile.mkdtemp(prefix="lazylog-grep-")
+
+    @classmethod
+    def tearDown(cls):
+        termSpecs = {"color": True, "splitLines": True, "level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs)
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def write(self, fileSpecs, records):
+        Logger.init(
+            self.folder, termSpecs={"level": logging.CRITICAL}, fileSpecs=fileSpecs
+        )
+        log = logging.getLogger("grep")
+        for created, level, msg in records:
+            record = log.makeRecord("grep", level, __file__, 10, msg, (), None, "write")
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+            log.handle(record)
+        for h in Logger.getHandlers():
+            h.flush()
+        Compressor.instance().join()
+
+    def test_001_console_and_json(self):
+        """
+        Filter by time, level and pattern over rotated, compressed files
+        """
+        start = time.mktime((2024, 1, 2, 14, 0, 0, 0, 0, -1))
+        records = [
+            (
+                start + i * 10,
+                logging.WARNING if i % 10 == 0 else logging.INFO,
+                "event %d" % i,
+            )
+            for i in range(100)
+        ]
+        records[50] = (records[50][0], logging.ERROR, "multi\nline %d" % 50)
+        self.write(
+            [
+                {
+                    "filename": "app.log",
+                    "level": logging.DEBUG,
+                    "maxBytes": 2000,
+                    "rotation": "sequence",
+                    "compress": "gzip",
+                },
+                {
+                    "filename": "app.json",
+                    "level": logging.DEBUG,
+                    "format": "json",
+                    "maxBytes": 2000,
+                },
+            ],
+            records,
+        )
+        path = os.path.join(self.folder, "app.log")
+        jpath = os.path.join(self.folder, "app.json")
+        self.assertTrue(len(glob.glob(path + ".*.gz")) > 2)
+        self.assertTrue(len(glob.glob(jpath + ".*")) > 2)
+
+        # Everything, oldest first
+        q = grep.Query()
+        found = list(grep.query(path, q, jobs=2))
+        self.assertEqual(100, len(found))
+        self.assertEqual(sorted(found), found)
+        self.assertTrue(found[50][1].endswith(": line 50\n"))
+        self.assertEqual(2, found[50][1].count("\n"))
+
+        # Time range and level, both formats merged
+        q = grep.Query(since=start + 200, until=start + 600, level="WARNING")
+        found = list(grep.query([path, jpath], q, jobs=1))
+        self.assertEqual(
+            [200, 200, 300, 300, 400, 400, 500, 500, 600, 600],
+            [int(t - start) for t, _ in found],
+        )
+        self.assertEqual("event 20", json.loads(found[1][1])["message"])
+        self.assertTrue(len(q.files(path)) < len(grep.logFiles(path)))
+
+        # Pattern
+        q = grep.Query("EVENT 9\\d", regex=True, ignoreCase=True, modules=["test_*"])
+        self.assertEqual(
+            ["event %d" % i for i in range(90, 100)],
+            [text.split(": ", 1)[1].strip() for _, text in grep.query(path, q)],
+        )
+
+    def test_002_parse_time(self):
+        """
+        Test the time formats of the command line
+        """
+        now = time.mktime((2024, 1, 2, 14, 0, 0, 0, 0, -1))
+        self.assertEqual(now - 900, grep.parseTime("-15m", now))
+        self.assertEqual(now + 125, grep.parseTime("14:02:05", now))
+        self.assertEqual(now, grep.parseTime("2024-01-02 14:00", now))
+        self.assertEqual(12.5, grep.parseTime("12.5", now))
+        self.assertAlmostEqual(
+            1525812016.943, grep.isoTime("2018-05-08T21:40:16.943+01:00")
+        )
+
+    def test_003_index(self):
+        """
+        The sidecar index narrows down what is read, not what is found
+        """
+        start = time.mktime((2024, 1, 2, 14, 0, 0, 0, 0, -1))
+        records = [
+            (start + i, logging.ERROR if i == 120 else logging.INFO, "event %d" % i)
+            for i in range(300)
+        ]
+        self.write(
+            [
+                {
+                    "filename": "app.log",
+                    "level": logging.DEBUG,
+                    "maxBytes": 8000,
+                    "rotation": "sequence",
+                    "compress": "gzip",
+                    "index": True,
+                    "indexRecords": 20,
+                }
+            ],
+            records,
+        )
+        path = os.path.join(self.folder, "app.log")
+        self.assertTrue(len(glob.glob(path + ".*.idx")) > 1)
+
+        plain = os.path.join(self.folder, "plain")
+        os.mkdir(plain)
+        for f in grep.logFiles(path):
+            shutil.copy2(f, plain)
+        plain = os.path.join(plain, "app.log")
+
+        for q in (
+            grep.Query(since=start + 100, until=start + 130),
+            grep.Query("event 12", since=start + 100, until=start + 200),
+            grep.Query(level="ERROR"),
+        ):
+            found = list(grep.query(path, q, jobs=1))
+            self.assertTrue(found)
+            self.assertEqual(list(grep.query(plain, q, jobs=1)), found)
+
+        # Only the blocks around the window are read
+        q = grep.Query(since=start + 100, until=start + 130)
+        backup = q.files(path)[0]
+        with openFile(backup, "rt") as f:
+            self.assertTrue(len(q._indexed(backup)) * 2 < len(f.read()))
+        self.assertEqual(None, q._indexed(plain))
+
+    def test_004_same_preamble(self):
+        """
+        Records with the same preamble are grouped, a pattern prints only its
+        lines
+        """
+        start = time.mktime((2024, 1, 2, 14, 0, 0, 0, 0, -1))
+        self.write(
+            [{"filename": "app.log", "level": logging.DEBUG}],
+            [
+                (start, logging.INFO, "alpha"),
+                (start, logging.INFO, "beta"),
+                (start + 1, logging.INFO, "gamma\ndelta"),
+            ],
+        )
+        path = os.path.join(self.folder, "app.log")
+
+        found = list(grep.query(path, grep.Query("beta")))
+        self.assertEqual(1, len(found))
+        self.assertTrue(found[0][1].endswith(": beta\n"))
+        self.assertEqual(1, found[0][1].count("\n"))
+
+        found = list(grep.query(path, grep.Query("ga.*\\n.*de", regex=True)))
+        self.assertEqual(2, found[0][1].count("\n"))
+
+        found = list(grep.query(path, grep.Query(level="INFO")))
+        self.assertEqual([2, 2], [text.count("\n") for _, text in found])
@@ -1,11 +1,13 @@
 import os
 import sys
+import time
 import json
 import logging
 import unittest
 import tempfile
 import traceback
 import datetime
+import lazylog
 from lazylog import Logger
 
 LOGDIR = tempfile.gettempdir()
@@ -383,3 +385,1168 @@ class Testlazylog(unittest.TestCase):
 
         self.assertEqual(logging.DEBUG, logging.getLogger().handlers[0].level)
         self.assertEqual(logging.WARNING, logging.getLogger().handlers[1].level)
+
+    def test_019_queue(self):
+        """
+        Test queue mode keeps mocking, levels and files working
+        """
+        rmlog()
+        fileSpecs = [{"filename": LOGFILE, "level": logging.DEBUG}]
+        termSpecs = {"color": True, "splitLines": True, "level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs, queue=True)
+
+        strio = logging.getLoggerClass().mockHandler(0)
+        logging.debug("Hello\nWorld")
+        logging.getLoggerClass().restoreHandler(0)
+
+        self.assertEqual(2, len(strio.getvalue().splitlines()))
+
+        Logger.setConsoleLevel(logging.WARNING)
+        Logger.setFileLevel(1, logging.ERROR)
+        self.assertEqual(logging.WARNING, Logger.getHandlers()[0].level)
+        self.assertEqual(logging.ERROR, Logger.getHandlers()[1].level)
+
+        logging.info("Not in the file")
+        logging.error("In the file")
+        Logger.stopQueue()
+
+        with open(LOGPATH) as f:
+            cont = f.read()
+
+        self.assertEqual(3, len(cont.splitlines()), msg="Got: %s" % cont)
+        self.assertFalse("Not in the file" in cont)
+
+    def test_020_color_split_fast_path(self):
+        """
+        Test the preamble is repeated on each line and colors wrap the record
+        """
+        from lazylog import ColorFormatter
+
+        formatter = ColorFormatter("%(levelname)s> %(message)s <", color=True)
+        record = logging.LogRecord("t", logging.ERROR, __file__, 1, "a\nb", None, None)
+
+        self.assertEqual(
+            "\033[1;31mERROR> a\nERROR> b <\033[0m", formatter.format(record)
+        )
+
+        # Formats that do not contain a plain message still work
+        formatter = ColorFormatter("%(levelname)s> %(message)-5s|", color=False)
+        self.assertEqual("ERROR> a\nERROR> b  |", formatter.format(record))
+
+    def test_021_file_json_static(self):
+        """
+        Test constant fields are included and extras can override them
+        """
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "format": "json",
+                "static": {"hostname": "box1", "app": "tests"},
+            }
+        ]
+        termSpecs = {"color": True, "splitLines": True, "level": logging.WARNING}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        logging.debug("Hello %s", "World")
+        logging.debug("Moved", extra={"hostname": "box2"})
+
+        with open(LOGPATH) as f:
+            lines = [json.loads(l) for l in f.read().splitlines()]
+
+        self.assertEqual("Hello World", lines[0]["message"])
+        self.assertEqual("box1", lines[0]["hostname"])
+        self.assertEqual("tests", lines[0]["app"])
+        self.assertEqual(os.getpid(), lines[0]["process"])
+        self.assertEqual("box2", lines[1]["hostname"])
+        self.assertEqual("tests", lines[1]["app"])
+
+    def test_022_file_buffered(self):
+        """
+        Test buffered records are written in batches, on errors and on flush
+        """
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "bufferSize": 3,
+                "flushInterval": 60000,
+            }
+        ]
+        termSpecs = {"color": True, "splitLines": True, "level": logging.WARNING}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        def lines():
+            with open(LOGPATH) as f:
+                return len(f.read().splitlines())
+
+        logging.debug("one")
+        logging.debug("two")
+        self.assertEqual(0, lines())
+
+        logging.debug("three")
+        self.assertEqual(3, lines())
+
+        logging.debug("four")
+        logging.error("five")
+        self.assertEqual(5, lines())
+
+        logging.debug("six")
+        Logger.getHandlers()[1].flush()
+        self.assertEqual(6, lines())
+
+    def test_023_file_rotation_counter(self):
+        """
+        Test records are formatted once and truncation does not rotate early
+        """
+        from lazylog import RotatingFileHandler
+
+        class CountingFormatter(logging.Formatter):
+            calls = 0
+
+            def format(self, record):
+                CountingFormatter.calls += 1
+                return logging.Formatter.format(self, record)
+
+        rmlog()
+        handler = RotatingFileHandler(LOGPATH, maxBytes=100, backupCount=1)
+        handler.setFormatter(CountingFormatter("%(message)s"))
+        record = logging.LogRecord("t", logging.INFO, __file__, 1, "x" * 19, None, None)
+
+        for _ in range(4):
+            handler.handle(record)
+        self.assertEqual(4, CountingFormatter.calls)
+        self.assertEqual(80, os.path.getsize(LOGPATH))
+
+        # Someone else truncates: the counter is off but must not rotate
+        with open(LOGPATH, "w"):
+            pass
+        handler.handle(record)
+        self.assertFalse(os.path.exists(LOGPATH + ".1"))
+
+        for _ in range(5):
+            handler.handle(record)
+        handler.close()
+
+        # Like stdlib, rotate before reaching maxBytes
+        self.assertEqual(80, os.path.getsize(LOGPATH + ".1"))
+        self.assertEqual(40, os.path.getsize(LOGPATH))
+        os.unlink(LOGPATH + ".1")
+
+    def test_024_file_rotation_sequence(self):
+        """
+        Test sequence rotation keeps the newest backups within limits
+        """
+        import glob
+        from lazylog import RotatingFileHandler
+
+        rmlog()
+        for path in glob.glob(LOGPATH + ".*"):
+            os.unlink(path)
+
+        handler = RotatingFileHandler(
+            LOGPATH, maxBytes=100, backupCount=2, rotation="sequence"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for i in range(5):
+            for _ in range(4):
+                handler.handle(
+                    logging.LogRecord(
+                        "t", logging.INFO, __file__, 1, "%019d" % i, None, None
+                    )
+                )
+        handler.close()
+
+        self.assertEqual(
+            [LOGPATH + ".s3", LOGPATH + ".s4"], sorted(glob.glob(LOGPATH + ".*"))
+        )
+        with open(LOGPATH + ".s4") as f:
+            self.assertEqual("%019d" % 3, f.readline().strip())
+
+        # Budget only: each backup is 80 bytes so only one fits
+        handler = RotatingFileHandler(
+            LOGPATH, maxBytes=100, rotation="timestamp", maxTotalBytes=150
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for _ in range(20):
+            handler.handle(
+                logging.LogRecord("t", logging.INFO, __file__, 1, "x" * 19, None, None)
+            )
+        handler.close()
+
+        self.assertEqual(1, len(glob.glob(LOGPATH + ".2*")))
+        for path in glob.glob(LOGPATH + ".*"):
+            os.unlink(path)
+
+    def test_025_file_compress(self):
+        """
+        Test rotated files are compressed in the background
+        """
+        import glob
+        import gzip
+        from lazylog import Compressor
+
+        rmlog()
+        for path in glob.glob(LOGPATH + ".*"):
+            os.unlink(path)
+
+        # Leftovers of an interrupted run and of an earlier cascade setup
+        with open(LOGPATH + ".s1", "w") as f:
+            f.write("old\n")
+        with open(LOGPATH + ".s1.gz.tmp", "w") as f:
+            f.write("garbage")
+        with open(LOGPATH + ".1", "w") as f:
+            f.write("cascade\n")
+
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "format": "default",
+                "fmt": "%(message)s",
+                "maxBytes": 100,
+                "compress": "gzip",
+            }
+        ]
+        termSpecs = {"color": True, "splitLines": True, "level": logging.WARNING}
+        with self.assertRaises(RuntimeError):
+            Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        fileSpecs[0]["rotation"] = "sequence"
+        fileSpecs[0]["backupCount"] = 2
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        for _ in range(5):
+            logging.info("x" * 19)
+        Compressor.instance().join()
+
+        self.assertEqual(
+            [LOGPATH + ".1", LOGPATH + ".s1.gz", LOGPATH + ".s2.gz"],
+            sorted(glob.glob(LOGPATH + ".*")),
+        )
+        with open(LOGPATH + ".1") as f:
+            self.assertEqual("cascade\n", f.read())
+        with gzip.open(LOGPATH + ".s1.gz", "rt") as f:
+            self.assertEqual("old\n", f.read())
+        with gzip.open(LOGPATH + ".s2.gz", "rt") as f:
+            self.assertEqual(4, len(f.read().splitlines()))
+
+        for path in glob.glob(LOGPATH + ".*"):
+            os.unlink(path)
+
+    def test_026_pretty_limits(self):
+        """
+        Test the pretty printer limits and cycle detection
+        """
+        from lazylog import pretty
+
+        cyclic = {"a": 1}
+        cyclic["self"] = cyclic
+        self.assertEqual("(dict) {\n\t'a': 1,\n\t'self': {...}\n}", pretty(cyclic))
+
+        self.assertEqual(
+            "(list) [\n\t0,\n\t... (2 more)\n]", pretty([0, 1, 2], maxItems=1)
+        )
+        self.assertEqual("(list) [\n\t[...]\n]", pretty([[1]], maxDepth=1))
+        self.assertEqual("(list) [\n\t'xx...", pretty(["x" * 50], maxChars=6))
+
+        # Deeper than the recursion limit
+        deep = []
+        for _ in range(sys.getrecursionlimit() * 2):
+            deep = [deep]
+        self.assertTrue(pretty(deep).startswith("(list) [\n\t[\n\t\t["))
+
+        termSpecs = {"level": logging.DEBUG, "maxItems": 1}
+        Logger.init(LOGDIR, termSpecs=termSpecs)
+
+        strio = logging.getLoggerClass().mockHandler(0)
+        logging.debug(list(range(10)))
+        logging.getLoggerClass().restoreHandler(0)
+
+        self.assertEqual(4, len(strio.getvalue().splitlines()))
+
+    def test_027_lazy(self):
+        """
+        Test lazy messages are computed once and only when written
+        """
+        from lazylog import lazy
+
+        calls = []
+
+        def build(value):
+            calls.append(value)
+            return value
+
+        rmlog()
+        fileSpecs = [{"filename": LOGFILE, "level": logging.INFO, "format": "json"}]
+        termSpecs = {"level": logging.INFO}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        strio = logging.getLoggerClass().mockHandler(0)
+        logging.debug(lazy(build, "skipped"))
+        logging.info(lazy(build, {"hello": "world"}))
+        logging.info(lazy(build, "Hello %s"), "World")
+        logging.getLoggerClass().restoreHandler(0)
+
+        self.assertEqual([{"hello": "world"}, "Hello %s"], calls)
+        # Pretty dict + one line
+        self.assertEqual(4, len(strio.getvalue().splitlines()))
+
+        with open(LOGPATH) as f:
+            lines = [json.loads(l) for l in f.read().splitlines()]
+        self.assertEqual("world", lines[0]["hello"])
+        self.assertEqual("Hello World", lines[1]["message"])
+
+    def test_028_root_level(self):
+        """
+        Test the root level follows the lowest handler level
+        """
+        rmlog()
+        fileSpecs = [{"filename": LOGFILE, "level": logging.INFO}]
+        termSpecs = {"level": logging.WARNING}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        root = logging.getLogger()
+        self.assertEqual(logging.INFO, root.level)
+        self.assertFalse(root.isEnabledFor(logging.DEBUG))
+
+        Logger.setFileLevel(1, logging.ERROR)
+        self.assertEqual(logging.WARNING, root.level)
+
+        Logger.addFileLogger({"filename": LOGFILE, "level": logging.DEBUG})
+        self.assertEqual(logging.DEBUG, root.level)
+
+        Logger.init(LOGDIR, termSpecs={"level": logging.ERROR}, queue=True)
+        self.assertEqual(logging.ERROR, root.level)
+        Logger.setConsoleLevel(logging.INFO)
+        self.assertEqual(logging.INFO, root.level)
+        Logger.stopQueue()
+
+    def test_029_stats(self):
+        """
+        Test per-handler stats and the Prometheus dump
+        """
+        rmlog()
+        fileSpecs = [{"filename": LOGFILE, "level": logging.WARNING, "maxBytes": 200}]
+        termSpecs = {"level": logging.DEBUG}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        strio = logging.getLoggerClass().mockHandler(0)
+        logging.debug("one")
+        logging.info("two")
+        for _ in range(3):
+            logging.warning("x" * 100)
+        logging.getLoggerClass().restoreHandler(0)
+
+        console, logfile = Logger.stats()
+        self.assertEqual(
+            ("console", 5, 0),
+            (console["name"], console["emitted"], console["filtered"]),
+        )
+        self.assertEqual(
+            (LOGFILE, 3, 2), (logfile["name"], logfile["emitted"], logfile["filtered"])
+        )
+        self.assertEqual(len(strio.getvalue()), console["bytes"])
+        self.assertEqual(
+            sum(os.path.getsize(LOGPATH + s) for s in ("", ".1", ".2")),
+            logfile["bytes"],
+        )
+        self.assertEqual(2, logfile["rotations"])
+        self.assertTrue(console["formatTime"] >= console["formatMax"] > 0)
+        self.assertTrue(console["emitTime"] >= console["formatTime"])
+
+        path = LOGPATH + ".prom"
+        Logger.dumpStats(path)
+        with open(path) as f:
+            cont = f.read()
+        os.unlink(path)
+        for path in [LOGPATH + ".1", LOGPATH + ".2"]:
+            os.unlink(path)
+
+        self.assertTrue(
+            'lazylog_records_emitted_total{handler="1",name="%s"} 3' % LOGFILE in cont,
+            msg="Got: %s" % cont,
+        )
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_030_file_multiprocess(self):
+        """
+        Test several processes rotating the same file lose no lines
+        """
+        import glob
+        import shutil
+        from lazylog import RotatingFileHandler
+
+        folder = tempfile.mkdtemp(prefix="lazylog-mp-")
+        path = os.path.join(folder, LOGFILE)
+        workers, lines = 4, 300
+
+        pids = []
+        for w in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    h = RotatingFileHandler(
+                        path, maxBytes=2000, rotation="sequence", multiprocess=True
+                    )
+                    h.setFormatter(logging.Formatter("%(message)s"))
+                    for i in range(lines):
+                        h.handle(logging.makeLogRecord({"msg": "%d-%d" % (w, i)}))
+                    h.close()
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                os._exit(code)
+            pids.append(pid)
+
+        for pid in pids:
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+        got = []
+        for name in glob.glob(path + "*"):
+            if not name.endswith(".lock"):
+                with open(name) as f:
+                    got.extend(f.read().splitlines())
+        backups = glob.glob(path + ".s[0-9]*")
+        shutil.rmtree(folder)
+
+        expected = ["%d-%d" % (w, i) for w in range(workers) for i in range(lines)]
+        self.assertEqual(sorted(expected), sorted(got))
+        self.assertTrue(len(backups) >= 3, msg="Got: %s" % backups)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    @unittest.skipIf(
+        lazylog.shared_memory is None, "needs multiprocessing.shared_memory"
+    )
+    def test_031_ring(self):
+        """
+        Test forked processes log through the shared memory ring
+        """
+        from lazylog import SharedRing
+
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "format": "default",
+                "fmt": "%(process)d %(message)s",
+            }
+        ]
+        termSpecs = {"level": logging.CRITICAL}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs, ringSize=1 << 20)
+
+        pids = []
+        for w in range(3):
+            pid = os.fork()
+            if pid == 0:
+                for i in range(100):
+                    logging.info("%d-%d", w, i)
+                os._exit(0)
+            pids.append(pid)
+        logging.info("parent")
+
+        for pid in pids:
+            os.waitpid(pid, 0)
+        Logger.flush()
+        self.assertEqual(0, Logger.dropped())
+        Logger.stopQueue()
+
+        with open(LOGPATH) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(301, len(lines))
+        self.assertTrue("%d parent" % os.getpid() in lines)
+        for w, pid in enumerate(pids):
+            self.assertTrue("%d %d-99" % (pid, w) in lines)
+
+        # Overflow is counted, the ring wraps around
+        ring = SharedRing(64)
+        self.assertTrue(ring.put(b"x" * 40))
+        self.assertFalse(ring.put(b"y" * 40))
+        self.assertEqual(1, ring.dropped)
+        self.assertEqual([b"x" * 40], ring.get())
+        self.assertTrue(ring.put(b"y" * 40))
+        self.assertEqual([b"y" * 40], ring.get())
+        ring.close()
+
+    def test_032_file_binary(self):
+        """
+        Test binary files render as the console layout
+        """
+        import glob
+        import uuid
+        import pathlib
+        import decimal
+        from io import StringIO
+        from lazylog import ColorFormatter, BinaryFileHandler
+        from lazylog.render import render
+
+        binfile = LOGFILE + ".bin"
+        binpath = LOGPATH + ".bin"
+        rmlog()
+        for path in glob.glob(binpath + "*"):
+            os.unlink(path)
+
+        fileSpecs = [
+            {"filename": LOGFILE, "level": logging.DEBUG},
+            {"filename": binfile, "level": logging.DEBUG, "format": "binary"},
+        ]
+        termSpecs = {"level": logging.CRITICAL}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+
+        log = logging.getLogger("bin")
+        for i in range(50):
+            log.info("Request %d took %.2fms for %s", i, i / 3.0, "user%d" % i)
+        log.warning({"a": 1, "b": [1, 2]})
+        log.debug("%(x)s and %(y)d", {"x": "mapping", "y": 3})
+        log.info("multi\nline", extra={"user": "me"})
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.exception("failed")
+        for h in Logger.getHandlers():
+            h.flush()
+
+        out = StringIO()
+        formatter = ColorFormatter(
+            Logger.LOGFORMAT, datefmt=Logger.DATEFORMAT, color=False
+        )
+        self.assertEqual(54, render(binpath, formatter, out))
+
+        with open(LOGPATH) as f:
+            text = f.read()
+        self.assertEqual(text, out.getvalue())
+        self.assertTrue(os.path.getsize(binpath) * 2 < len(text))
+
+        # Arguments that would not come back the same are rendered when
+        # written. Ones that do not fit are shown as they are, the rest follows
+        records = [
+            ("%r in %r", (pathlib.PurePosixPath("/x"), uuid.UUID(int=1))),
+            ("%r and %r", ((1, 2), [1, 2])),
+            ("%d items of %r", (decimal.Decimal(3), b"raw")),
+            ({"a": (1, 2), "b": [b"c", None]}, ()),
+            ("%d", ("x",)),
+            ("%d", (2,)),
+        ]
+        records = [
+            logging.LogRecord("b", 20, "f.py", 1, msg, args, None)
+            for msg, args in records
+        ]
+        handler = BinaryFileHandler(binpath + "-odd")
+        for record in records:
+            handler.handle(record)
+        handler.close()
+        out = StringIO()
+        formatter = logging.Formatter("%(message)s")
+        self.assertEqual(6, render(binpath + "-odd", formatter, out))
+        os.unlink(binpath + "-odd")
+        expected = [formatter.format(record) for record in records[:4]]
+        expected += ["'%d' % ('x',)", "2"]
+        self.assertEqual(expected, out.getvalue().splitlines())
+
+        # Every file has its own tables
+        Logger.init(
+            LOGDIR,
+            termSpecs=termSpecs,
+            fileSpecs=[
+                {
+                    "filename": binfile,
+                    "level": logging.DEBUG,
+                    "format": "binary",
+                    "maxBytes": 500,
+                    "rotation": "sequence",
+                },
+            ],
+        )
+        for i in range(30):
+            log.info("Request %d took %.2fms for %s", i, i / 3.0, "user%d" % i)
+        Logger.getHandlers()[1].flush()
+
+        backups = sorted(
+            glob.glob(binpath + ".*"), key=lambda p: int(p.rsplit(".s", 1)[1])
+        )
+        self.assertTrue(len(backups) > 1)
+        count = 0
+        out = StringIO()
+        for path in backups + [binpath]:
+            count += render(path, logging.Formatter("%(message)s"), out)
+        self.assertEqual(54 + 30, count)
+        self.assertTrue(
+            out.getvalue().endswith("\nRequest 29 took 9.67ms for user29\n")
+        )
+
+        for path in glob.glob(binpath + "*"):
+            os.unlink(path)
+
+    def test_033_file_index(self):
+        """
+        Test the sidecar index points at the records and rotates with the file
+        """
+        import glob
+        from lazylog import RotatingFileHandler
+
+        rmlog()
+        for path in glob.glob(LOGPATH + ".*"):
+            os.unlink(path)
+
+        fmt = "%(created)f %(levelname)s %(message)s"
+        for rotation in ("cascade", "sequence"):
+            fileSpecs = [
+                {
+                    "filename": LOGFILE,
+                    "level": logging.DEBUG,
+                    "fmt": fmt,
+                    "index": True,
+                    "indexRecords": 10,
+                    "indexBytes": 300,
+                    "maxBytes": 2000,
+                    "backupCount": 3,
+                    "rotation": rotation,
+                },
+            ]
+            Logger.init(
+                LOGDIR, termSpecs={"level": logging.CRITICAL}, fileSpecs=fileSpecs
+            )
+            log = logging.getLogger("index")
+            for i in range(200):
+                log.log(logging.ERROR if i == 150 else logging.INFO, "Request %d", i)
+            Logger.init(LOGDIR, termSpecs={"level": logging.CRITICAL})
+
+            backups = glob.glob(LOGPATH + ".[0-9]") + glob.glob(LOGPATH + ".s[0-9]")
+            self.assertEqual(3, len(backups))
+            levels = []
+            for path in backups + [LOGPATH]:
+                entries = RotatingFileHandler.readIndex(path)
+                with open(path, "rb") as f:
+                    data = f.read()
+                pos = 0
+                for low, high, start, end, level in entries:
+                    # Contiguous blocks of whole records within their times
+                    self.assertEqual(pos, start)
+                    self.assertTrue(data.rfind(b"\n", start, end - 1) + 1 - start < 300)
+                    lines = data[start:end].decode().splitlines()
+                    self.assertTrue(len(lines) <= 10)
+                    times = [float(line.split()[0]) for line in lines]
+                    # %f rounds to microseconds
+                    self.assertTrue(
+                        low - 1e-6 <= min(times) and max(times) <= high + 1e-6
+                    )
+                    levels.append(level)
+                    pos = end
+                self.assertEqual(len(data), pos)
+            self.assertEqual(logging.ERROR, max(levels))
+
+            for path in glob.glob(LOGPATH + ".*"):
+                os.unlink(path)
+            rmlog()
+
+    def test_034_rate_limit(self):
+        """
+        Test a hot call site is limited and summarized, the others are not
+        """
+        from lazylog import RateLimitFilter
+
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "fmt": "%(levelname)s %(message)s",
+                "rateLimit": {
+                    "rate": {"WARNING": 0.001},
+                    "burst": 5,
+                    "sample": {"DEBUG": 10},
+                    "interval": 60,
+                },
+            },
+        ]
+        termSpecs = {"level": logging.CRITICAL, "rateLimit": {"rate": 1}}
+        Logger.init(LOGDIR, termSpecs=termSpecs, fileSpecs=fileSpecs)
+        self.assertEqual(1, len(Logger.getHandlers()[0].filters))
+
+        log = logging.getLogger("hot")
+        for i in range(100):
+            log.warning("hot %d", i)
+            if i % 10 == 0:
+                log.info("cold %d", i)
+        for i in range(30):
+            log.debug("sampled %d", i)
+
+        # A summary on the first record after the interval
+        record = log.makeRecord("hot", logging.INFO, __file__, 1, "later", (), None)
+        record.created += 61
+        log.handle(record)
+        Logger.getHandlers()[1].flush()
+
+        with open(LOGPATH) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(
+            ["WARNING hot %d" % i for i in range(5)],
+            [l for l in lines if l.startswith("WARNING hot")],
+        )
+        self.assertEqual(10, len([l for l in lines if l.startswith("INFO cold")]))
+        self.assertEqual(
+            ["DEBUG sampled 0", "DEBUG sampled 10", "DEBUG sampled 20"],
+            [l for l in lines if "sampled" in l],
+        )
+        self.assertTrue(
+            lines[-2].startswith("WARNING Suppressed 122 records from 2 call sites")
+        )
+        self.assertTrue("test_lazylog.py:" in lines[-2] and " (95), " in lines[-2])
+        self.assertEqual("INFO later", lines[-1])
+
+        # Summarized on flush, without waiting for a later record
+        for i in range(8):
+            log.warning("hot again")
+        Logger.getHandlers()[1].flush()
+        with open(LOGPATH) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(
+            lines[-1].startswith("WARNING Suppressed 3 records from 1 call sites")
+        )
+
+        # And by its timer, without records or flushes
+        timed = RateLimitFilter(rate=0, burst=1, interval=0.05)
+        for i in range(3):
+            timed.filter(log.makeRecord("timed", 30, "t.py", 1, "x", (), None))
+        time.sleep(0.2)
+        Logger.getHandlers()[1].flush()
+        with open(LOGPATH) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[-1].startswith("WARNING Suppressed 2 records"))
+
+        self.assertRaises(RuntimeError, RateLimitFilter, sample=0)
+        self.assertRaises(RuntimeError, RateLimitFilter, rate={"INFO": -1})
+
+    def test_035_dedup(self):
+        """
+        Test repeated records are collapsed, in console and JSON files
+        """
+        import time
+
+        jsonfile = LOGFILE + ".json"
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "fmt": "%(levelname)s %(message)s",
+                "dedup": True,
+            },
+            {
+                "filename": jsonfile,
+                "level": logging.DEBUG,
+                "format": "json",
+                "dedup": {"timeout": 0.1},
+            },
+        ]
+        Logger.init(LOGDIR, termSpecs={"level": logging.CRITICAL}, fileSpecs=fileSpecs)
+
+        log = logging.getLogger("dedup")
+        for i in range(1000):
+            log.warning("Connection to %s refused", "db")
+        log.warning("Connection to %s refused", "cache")
+        for i in range(3):
+            try:
+                raise ValueError("retry %d" % (i // 2))
+            except ValueError:
+                log.exception("failed")
+        for i in range(2):
+            log.error("Connection to %s refused", "db")
+        time.sleep(0.3)
+        for h in Logger.getHandlers():
+            h.flush()
+
+        with open(LOGPATH) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(
+            [
+                "WARNING Connection to db refused",
+                "WARNING Last message repeated 999 times",
+                "WARNING Connection to cache refused",
+                "ERROR failed",
+                "ERROR ValueError: retry 0",
+                "ERROR Last message repeated 1 times",
+                "ERROR failed",
+                "ERROR ValueError: retry 1",
+                "ERROR Connection to db refused",
+                # Pending repeats are written on flush
+                "ERROR Last message repeated 1 times",
+            ],
+            [l for l in lines if not l.startswith(("ERROR Traceback", "ERROR  "))],
+        )
+
+        # The shorter timeout wrote the last one before the flush, once
+        with open(LOGPATH + ".json") as f:
+            records = [json.loads(l) for l in f]
+        self.assertEqual(999, records[1]["repeated"])
+        self.assertEqual(1, records[-1]["repeated"])
+        self.assertEqual("Last message repeated 1 times", records[-1]["message"])
+        self.assertEqual(3, len([r for r in records if r.get("repeated")]))
+        os.unlink(LOGPATH + ".json")
+
+    def test_036_shared_format(self):
+        """
+        Test equivalent formatters render a record once
+        """
+        from lazylog import ColorFormatter
+
+        calls = []
+        formatFast = ColorFormatter._formatFast
+
+        def counting(self, record):
+            calls.append(record.msg)
+            return formatFast(self, record)
+
+        rmlog()
+        fileSpecs = [
+            {"filename": LOGFILE, "level": logging.DEBUG},
+            {"filename": LOGFILE + ".2", "level": logging.DEBUG, "pretty": True},
+        ]
+        Logger.init(
+            LOGDIR,
+            termSpecs={"level": logging.DEBUG, "color": True},
+            fileSpecs=fileSpecs,
+        )
+        strio = Logger.mockHandler(0)
+        ColorFormatter._formatFast = counting
+        try:
+            logging.info("shared %d", 1)
+            logging.info({"pretty": [1, 2]})
+        finally:
+            ColorFormatter._formatFast = formatFast
+            Logger.restoreHandler(0)
+        for h in Logger.getHandlers():
+            h.flush()
+
+        # Once for the string, the dict twice: pretty (console, second file)
+        # and not (first file)
+        self.assertEqual(3, len(calls))
+        self.assertEqual({"pretty": [1, 2]}, calls[2])
+        with open(LOGPATH) as f:
+            plain = f.read()
+        with open(LOGPATH + ".2") as f:
+            self.assertEqual(f.read().splitlines()[0], plain.splitlines()[0])
+        self.assertTrue(strio.getvalue().startswith(ColorFormatter.ESC))
+        self.assertTrue(plain.splitlines()[0] in strio.getvalue())
+        self.assertEqual(2, len(plain.splitlines()))
+        os.unlink(LOGPATH + ".2")
+
+    def test_037_timestamps(self):
+        """
+        Test cached times render as logging.Formatter and JSON ISO times
+        """
+        from lazylog import ColorFormatter, JSONFormatter
+        from lazylog.grep import isoTime
+
+        for fmt, datefmt in (
+            (Logger.LOGFORMAT, Logger.DATEFORMAT),
+            ("%(asctime)s %(message)s", None),
+        ):
+            ours = ColorFormatter(fmt, datefmt=datefmt, color=False)
+            theirs = logging.Formatter(fmt, datefmt=datefmt)
+            for created in (
+                1525812016.943,
+                1525812016.999,
+                1525812017.0,
+                1525812016.5,
+                1525899999.25,
+            ):
+                record = logging.makeLogRecord({"msg": "hi", "created": created})
+                record.msecs = (created - int(created)) * 1000
+                self.assertEqual(theirs.format(record), ours.format(record))
+
+            # Converters set after init are used, the same record included
+            def shifted(seconds):
+                return time.gmtime(seconds + 3600)
+
+            text = ours.format(record)
+            ours.converter = theirs.converter = shifted
+            self.assertEqual(theirs.format(record), ours.format(record))
+            self.assertNotEqual(text, ours.format(record))
+
+        formatter = JSONFormatter(["message"], timestamp="iso")
+        record = logging.makeLogRecord(
+            {"msg": "hi", "created": 1525812016.943, "msecs": 943.0}
+        )
+        timestamp = json.loads(formatter.format(record))["timestamp"]
+        self.assertTrue(
+            timestamp.startswith(
+                datetime.datetime.fromtimestamp(1525812016).strftime(
+                    "%Y-%m-%dT%H:%M:%S.943"
+                )
+            )
+        )
+        self.assertAlmostEqual(1525812016.943, isoTime(timestamp), places=3)
+        self.assertRaises(RuntimeError, JSONFormatter, ["message"], timestamp="nope")
+
+    def test_038_compiled_format(self):
+        """
+        Test compiled formats render exactly as % does
+        """
+        from lazylog import ColorFormatter
+
+        formats = (
+            Logger.LOGFORMAT,
+            "%(asctime)s.%(msecs)03d %(process)s:%(thread)u %(levelname)-8s "
+            "%(module)15.15s %(lineno)-4s: ",
+            "[%(levelname)8s|%(name)-5.3s|%(funcName)s] 100%% "
+            "%(lineno)05d %(created)f %(user)r",
+            "%(threadName)s %(thread)x %(levelno)+d %(relativeCreated)10.2f",
+            "no fields %%",
+            "",
+            "bad % format %(name)s",
+        )
+        record = logging.makeLogRecord(
+            {
+                "msg": "hi",
+                "message": "hi",
+                "asctime": "08-05-2018 21:40:16",
+                "msecs": 943.4,
+                "module": "some_long_module",
+                "levelname": "Level 5",
+                "levelno": 5,
+                "lineno": 7,
+                "name": "a.b",
+                "user": {"x": [1]},
+                "funcName": "fn",
+            }
+        )
+        for fmt in formats:
+            render = ColorFormatter.compile(fmt)
+            for levelname in ("INFO", "WARNING", "Level 5", "INFO"):
+                record.levelname = levelname
+                try:
+                    expected = fmt % record.__dict__
+                except (ValueError, TypeError) as e:
+                    self.assertRaises(type(e), render, record.__dict__)
+                    continue
+                self.assertEqual(expected, render(record.__dict__))
+
+        self.assertRaises(
+            KeyError, ColorFormatter.compile("%(missing)s"), record.__dict__
+        )
+
+    @unittest.skipIf(lazylog._CONTEXT is None, "needs contextvars")
+    def test_039_bind(self):
+        """
+        Test bound context ends up in JSON lines of its own thread/task only
+        """
+        import asyncio
+        import threading
+
+        rmlog()
+        fileSpecs = [
+            {
+                "filename": LOGFILE,
+                "level": logging.DEBUG,
+                "format": "json",
+                "fields": ["message"],
+                "static": {"app": "test"},
+            }
+        ]
+        Logger.init(
+            LOGDIR,
+            termSpecs={"level": logging.CRITICAL},
+            fileSpecs=fileSpecs,
+            queue=True,
+        )
+
+        log = lazylog.bind("bound", request_id=1, tenant="a")
+        log.info("first")
+        lazylog.bind(tenant="b")
+        logging.info("second", extra={"request_id": 2})
+
+        def other():
+            logging.info("other thread")
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+
+        async def request(rid):
+            lazylog.bind(request_id=rid)
+            await asyncio.sleep(0)
+            logging.info("task")
+
+        async def main():
+            lazylog.unbind()
+            await asyncio.gather(request(10), request(11))
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+        lazylog.unbind("tenant")
+        logging.info("third")
+        lazylog.unbind()
+        logging.info("last")
+        Logger.stopQueue()
+
+        with open(LOGPATH) as f:
+            lines = [json.loads(l) for l in f]
+        for line in lines:
+            del line["timestamp"]
+        self.assertEqual(
+            [
+                {"app": "test", "request_id": 1, "tenant": "a", "message": "first"},
+                {"app": "test", "request_id": 2, "tenant": "b", "message": "second"},
+                {"app": "test", "message": "other thread"},
+                {"app": "test", "request_id": 10, "message": "task"},
+                {"app": "test", "request_id": 11, "message": "task"},
+                {"app": "test", "request_id": 1, "message": "third"},
+                {"app": "test", "message": "last"},
+            ],
+            [
+                l
+                for l in lines
+                if "asyncio" not in l.get("message", "")
+                and "selector" not in l["message"]
+            ],
+        )
+
+    def test_040_compress_fork(self):
+        """
+        Test a forked child compresses with workers of its own
+        """
+        import shutil
+        from lazylog import Compressor
+
+        folder = tempfile.mkdtemp(prefix="lazylog-fork-")
+        compressor = Compressor.instance()
+        for name in ("parent", "child"):
+            with open(os.path.join(folder, name), "w") as f:
+                f.write(name)
+        compressor.submit(os.path.join(folder, "parent"), "gzip")
+        compressor.join()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                Compressor.instance().submit(os.path.join(folder, "child"), "gzip")
+                Compressor.instance().join()
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            os._exit(code)
+
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+        self.assertEqual(["child.gz", "parent.gz"], sorted(os.listdir(folder)))
+        shutil.rmtree(folder)
+
+    def test_041_file_fork(self):
+        """
+        Test a forked child neither writes the parent's buffer nor waits for
+        exit to flush its own
+        """
+        import shutil
+        import time
+        from lazylog import RotatingFileHandler
+
+        folder = tempfile.mkdtemp(prefix="lazylog-fork-")
+        path = os.path.join(folder, LOGFILE)
+        handler = RotatingFileHandler(
+            path, bufferSize=100, flushInterval=50, multiprocess=True
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        handler.handle(
+            logging.makeLogRecord({"msg": "before fork", "levelno": logging.INFO})
+        )
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                handler.handle(
+                    logging.makeLogRecord({"msg": "child", "levelno": logging.INFO})
+                )
+                time.sleep(0.5)
+                with open(path) as f:
+                    code = 0 if "child" in f.read().splitlines() else 2
+            except BaseException:
+                traceback.print_exc()
+            # No close() nor atexit
+            os._exit(code)
+
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+        handler.close()
+        with open(path) as f:
+            self.assertEqual(["before fork", "child"], sorted(f.read().splitlines()))
+        shutil.rmtree(folder)
+
+    def test_042_shared_format_filters(self):
+        """
+        Test a handler filter that rewrites the record is not bypassed by
+        what an earlier handler rendered
+        """
+        import copy
+
+        class Redact(logging.Filter):
+            def filter(self, record):
+                record.msg = record.msg.replace("password=%s", "password=***")
+                record.args = tuple(a for a in record.args if a != "hunter2")
+                return True
+
+        rmlog()
+        fileSpecs = [{"filename": LOGFILE, "level": logging.DEBUG}]
+        Logger.init(
+            LOGDIR,
+            termSpecs={"level": logging.DEBUG, "color": False},
+            fileSpecs=fileSpecs,
+        )
+        strio = Logger.mockHandler(0)
+        Logger.getHandlers()[1].addFilter(Redact())
+        try:
+            logging.info("login %s password=%s", "me", "hunter2")
+            record = logging.makeLogRecord({"msg": "original", "levelno": 20})
+            console = Logger.getHandlers()[0].format(record)
+            other = copy.copy(record)
+            other.msg = "copy"
+            self.assertTrue(Logger.getHandlers()[0].format(other).endswith(": copy"))
+            self.assertEqual(console, Logger.getHandlers()[0].format(record))
+        finally:
+            Logger.restoreHandler(0)
+        Logger.getHandlers()[1].flush()
+
+        self.assertTrue("password=hunter2" in strio.getvalue())
+        self.assertFalse(hasattr(record, "_formatted"))
+        with open(LOGPATH) as f:
+            text = f.read()
+        self.assertTrue(text.strip().endswith(": login me password=***"))
+
+    def test_043_queue_snapshot(self):
+        """
+        Test queue mode logs what was passed at the call, not at write time
+        """
+        from lazylog import lazy
+
+        rmlog()
+        fileSpecs = [
+            {"filename": LOGFILE, "level": logging.DEBUG, "fmt": "%(message)s"}
+        ]
+        Logger.init(
+            LOGDIR,
+            termSpecs={"level": logging.CRITICAL},
+            fileSpecs=fileSpecs,
+            queue=True,
+        )
+        state = {"step": 1}
+        items = [1]
+        calls = []
+        logging.info(state)
+        logging.info("items=%s", items)
+        logging.info("lazy %s", lazy(lambda: calls.append(1) or len(calls)))
+        state["step"] = 2
+        items.append(2)
+        Logger.stopQueue()
+
+        with open(LOGPATH) as f:
+            self.assertEqual(
+                ["{'step': 1}", "items=[1]", "lazy 1"], f.read().splitlines()
+            )
+        rmlog()